@@ -1,10 +1,170 @@
 import abc
+import numpy as np
+from ..engine import get_rng
+from ..utils import BufferPool
+
+
+def select_params(params, index):
+    """
+    Parameters of the images selected by index (a slice, mask or index array) from per-batch parameters as
+    returned by Augmentation.sample().
+    """
+    if params is None:
+        return None
+    if isinstance(params, list):
+        return [select_params(p, index) for p in params]
+    return dict((key, value[index]) for key, value in params.items())
+
 
 class Augmentation(object):
     """
     Apply a certain augmentation onto a set of data tensors.
+    Random augmentations draw all their parameters for a batch at once in sample(). Passing the same parameters to
+    apply() again replays the augmentation exactly.
     """
 
+    def sample(self, values, rng):
+        """
+        Random parameters for the batch in values as a dict of arrays with one entry per image, drawn from the
+        numpy Generator rng. None if the augmentation is not random.
+        """
+        return None
+
+    def params_for(self, values, params=None):
+        if params is None:
+            params = self.sample(values, get_rng())
+        return params
+
     @abc.abstractmethod
-    def apply(self, values, deterministic=False):
-        return
\ No newline at end of file
+    def apply(self, values, deterministic=False, params=None):
+        return
+
+
+class PointwiseAugmentation(Augmentation):
+    """
+    Augmentation that maps every pixel of an image independently of the other images in the batch, so it can be
+    applied to any block of whole images in place. Consecutive pointwise augmentations are fused into a single pass
+    over the batch by the Augmentations node, see fuse_pointwise().
+    """
+
+    def result_dtype(self, dtype):
+        """
+        Dtype of the images after this augmentation, given the input dtype.
+        """
+        return dtype
+
+    @abc.abstractmethod
+    def transform(self, images, deterministic=False, params=None):
+        """
+        Apply the augmentation to a block of images in place. params are those of the images in the block.
+        """
+        return
+
+    def apply(self, values, deterministic=False, params=None):
+        return FusedPointwise([self]).apply(values, deterministic, None if params is None else [params])
+
+
+def convert(images, dtype, out=None):
+    """
+    Convert images to dtype, rounding and clipping floats that become integers. Writes into out if it has that
+    dtype and returns a new array otherwise.
+    """
+    if dtype.kind in 'iu' and images.dtype.kind == 'f':
+        info = np.iinfo(dtype)
+        images = np.clip(np.rint(images), info.min, info.max)
+    if out is not None and out.dtype == dtype:
+        out[...] = images
+        return out
+    return images.astype(dtype)
+
+
+class FusedPointwise(Augmentation):
+    """
+    Runs several pointwise augmentations in one pass: the batch is processed in blocks of about chunk_bytes which
+    go through all augmentations while they are still in cache. Images are converted to dtype at the end, which
+    defaults to whatever the augmentations produce. Without augmentations this is a plain cast.
+    """
+
+    def __init__(self, transforms, dtype=None, chunk_bytes=1 << 20):
+        self.transforms = list(transforms)
+        self.dtype = dtype
+        self.chunk_bytes = chunk_bytes
+        self.pool = BufferPool()
+
+    def result_dtype(self, dtype):
+        for transform in self.transforms:
+            dtype = np.dtype(transform.result_dtype(dtype))
+        return dtype
+
+    def dtypes(self, dtype):
+        """
+        Dtypes of the images before and after every augmentation.
+        """
+        dtypes = [np.dtype(dtype)]
+        for transform in self.transforms:
+            dtypes.append(np.dtype(transform.result_dtype(dtypes[-1])))
+        return dtypes
+
+    def sample(self, values, rng):
+        params = [transform.sample(values, rng) for transform in self.transforms]
+        if all(p is None for p in params):
+            return None
+        return params
+
+    def apply(self, values, deterministic=False, params=None):
+        images = np.asarray(values['images'])
+        if deterministic:
+            params = None
+        else:
+            params = self.params_for(values, params)
+        if params is None:
+            params = [None] * len(self.transforms)
+        dtypes = self.dtypes(images.dtype)
+        out_dtype = np.dtype(self.dtype) if self.dtype is not None else dtypes[-1]
+        if not self.transforms and out_dtype == images.dtype:
+            return values
+
+        # Every augmentation runs in its own input dtype, so e.g. uint8 stays uint8 until an augmentation changes it
+        in_place = all(dtype == out_dtype for dtype in dtypes) and images.flags.writeable
+        out = images if in_place else self.pool.acquire(images.shape, out_dtype)
+        itemsize = max(dtype.itemsize for dtype in dtypes)
+        image_bytes = max(1, images[0].size * itemsize) if len(images) else 1
+        step = max(1, self.chunk_bytes // image_bytes)
+        for start in range(0, len(images), step):
+            block = slice(start, start + step)
+            target = out[block]
+            chunk = target if in_place else None
+            for transform, p, dtype in zip(self.transforms, params, dtypes[1:]):
+                if chunk is None or chunk.dtype != dtype:
+                    chunk = convert(images[block] if chunk is None else chunk, dtype, target)
+                transform.transform(chunk, deterministic, select_params(p, block))
+            if chunk is not target:
+                convert(images[block] if chunk is None else chunk, out_dtype, target)
+        values['images'] = out
+        return values
+
+
+def fuse_pointwise(transforms, dtype=None):
+    """
+    Replace each run of consecutive pointwise augmentations by a FusedPointwise. With a dtype, the images are
+    converted to it at the end of the chain.
+    """
+    fused = []
+    run = []
+    for transform in transforms:
+        if isinstance(transform, PointwiseAugmentation):
+            run.append(transform)
+            continue
+        if run:
+            fused.append(FusedPointwise(run))
+            run = []
+        fused.append(transform)
+    if run:
+        fused.append(FusedPointwise(run))
+
+    if dtype is not None:
+        if fused and isinstance(fused[-1], FusedPointwise):
+            fused[-1].dtype = dtype
+        else:
+            fused.append(FusedPointwise([], dtype))
+    return fused
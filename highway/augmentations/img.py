@@ -1,9 +1,9 @@
 import abc
+import os
 
-from scipy.misc import imresize
-
-from .base import Augmentation
+from .base import Augmentation, PointwiseAugmentation
 from ..transforms.img import *
+from ..utils import BufferPool
 
 
 class FlipX(Augmentation):
@@ -11,18 +11,16 @@ class FlipX(Augmentation):
     Flig image along x axis
     """
 
-    def apply(self, values, deterministic=False):
+    def sample(self, values, rng):
+        return {'flip': rng.integers(2, size=len(values['images'])) == 0}
+
+    def apply(self, values, deterministic=False, params=None):
         if deterministic:
             # todo
             return values
         else:
-            images = values['images']
-            for idx in range(images.shape[0]):
-                image = images[idx]
-                p = np.random.randint(2)
-                if p == 0:
-                    image = flip_x(image)
-                    images[idx] = image
+            params = self.params_for(values, params)
+            flip_x_batch(values['images'], params['flip'])
             return values
 
 
@@ -35,28 +33,26 @@ class PadCrop(Augmentation):
         self.padsize = padsize
         self.mode = mode
 
-    def apply(self, values, deterministic=False):
+    def sample(self, values, rng):
+        n = len(values['images'])
+        return {'y': rng.integers(2 * self.padsize + 1, size=n), 'x': rng.integers(2 * self.padsize + 1, size=n)}
+
+    def apply(self, values, deterministic=False, params=None):
 
         if deterministic:
             # todo
             return values
         else:
             images = values['images']
-            for idx in range(images.shape[0]):
-                image = images[idx]
-                cx = np.random.randint(2 * self.padsize)
-                cy = np.random.randint(2 * self.padsize)
-
-                padded = pad(image, (self.padsize, self.padsize), self.mode)
-                x = image.shape[2]
-                y = image.shape[1]
-                images[idx] = crop(padded, (cy, cx), (y, x))
+            params = self.params_for(values, params)
+            padded = pad_batch(images, (self.padsize, self.padsize), self.mode)
+            values['images'] = crop_batch(padded, params['y'], params['x'], images.shape[1:3])
             return values
 
 
-class AdditiveNoise(Augmentation):
+class AdditiveNoise(PointwiseAugmentation):
     """
-    Additive noise for images
+    Additive noise for images. Integer images become float32.
     """
 
     def __init__(self, strength=0.2, mu=0, sigma=50):
@@ -64,15 +60,19 @@ class AdditiveNoise(Augmentation):
         self.mu = mu
         self.sigma = sigma
 
-    def apply(self, values, deterministic=False):
+    def result_dtype(self, dtype):
+        return dtype if np.dtype(dtype).kind == 'f' else np.float32
+
+    def sample(self, values, rng):
+        # Noise is drawn from one seed per image, so it can be replayed without storing it
+        return {'seed': rng.integers(2 ** 63 - 1, size=len(values['images']))}
+
+    def transform(self, images, deterministic=False, params=None):
         if deterministic:
-            # todo
-            return values
-        else:
-            images = values['images']
-            noisy = add_noise(images, self.strengt, self.mu, self.sigma)
-            values['images'] = noisy
-            return values
+            return
+        params = self.params_for({'images': images}, params)
+        for image, seed in zip(images, params['seed']):
+            image += self.strength * np.random.default_rng(seed).normal(self.mu, self.sigma, image.shape)
 
 
 class Shift(Augmentation):
@@ -84,19 +84,21 @@ class Shift(Augmentation):
         self.shift = shift
         self.mode = mode
 
-    def apply(self, values, deterministic=False):
+    def sample(self, values, rng):
+        images = values['images']
+        x_range = int(self.shift * images.shape[2])
+        y_range = int(self.shift * images.shape[1])
+        return {'y': rng.integers(-y_range, y_range, size=len(images)),
+                'x': rng.integers(-x_range, x_range, size=len(images))}
+
+    def apply(self, values, deterministic=False, params=None):
         if deterministic:
             # todo
             return values
         images = values['images']
+        params = self.params_for(values, params)
         for idx in range(images.shape[0]):
-            image = images[idx]
-            x_range = self.shift * image.shape[1]
-            y_range = self.shift * image.shape[0]
-            x = np.random.randint(-x_range, x_range)
-            y = np.random.randint(-y_range, y_range)
-
-            images[idx] = shift(image, (y, x),  mode=self.mode)
+            images[idx] = shift(images[idx], (params['y'][idx], params['x'][idx]),  mode=self.mode)
         return values
 
 
@@ -110,16 +112,18 @@ class Rotate(Augmentation):
         self.order = order
         self.reshape = reshape
 
-    def apply(self, values, deterministic=False):
+    def sample(self, values, rng):
+        return {'angle': rng.integers(-self.angle, self.angle, size=len(values['images']))}
+
+    def apply(self, values, deterministic=False, params=None):
         if deterministic:
             # todo
             return values
         images = values['images']
+        params = self.params_for(values, params)
         for idx in range(len(images)):
-            image = images[idx]
-            rot_angle = np.random.randint(-self.angle, self.angle)
             new_image = rotate(
-                image, rot_angle, order=self.order, reshape=self.reshape)
+                images[idx], params['angle'][idx], order=self.order, reshape=self.reshape)
             images[idx] = new_image
         return values
 
@@ -133,30 +137,83 @@ class Zoom(Augmentation):
         self.fac = fac
         self.order = order
 
-    def apply(self, values, deterministic=False):
+    def sample(self, values, rng):
+        n = len(values['images'])
+        return {'factor': rng.uniform(1 - self.fac, 1 + self.fac, size=n), 'position': rng.random((n, 2))}
+
+    def apply(self, values, deterministic=False, params=None):
         if deterministic:
             # todo
             return values
 
         images = values['images']
+        params = self.params_for(values, params)
         for idx in range(len(images)):
-            image = images[idx]
-            fac = np.random.uniform(1 - self.fac, 1 + self.fac)
-            new_image = clipped_zoom(image, zoom_factor=fac, order=self.order)
+            new_image = clipped_zoom(images[idx], zoom_factor=params['factor'][idx],
+                                     position=params['position'][idx], order=self.order)
             images[idx] = new_image
         return values
 
 
-class HistEq(Augmentation):
+class RandomAffine(Augmentation):
+    """
+    Shift, rotate and zoom images with a single resampling pass. Per image, translation is drawn within
+    (-shift, +shift) times the image size, the angle within (-angle, +angle) degrees and the scale within
+    (1-zoom, 1+zoom). The three are composed into one affine matrix, so images are interpolated only once and keep
+    their dtype.
+    """
+
+    def __init__(self, shift=0., angle=0., zoom=0., order=1, mode='constant', cval=0.):
+        self.shift = shift
+        self.angle = angle
+        self.zoom = zoom
+        self.order = order
+        self.mode = mode
+        self.cval = cval
+        self.pool = BufferPool()
+
+    def sample(self, values, rng):
+        n, height, width = values['images'].shape[:3]
+        return {'y': rng.uniform(-self.shift, self.shift, size=n) * height,
+                'x': rng.uniform(-self.shift, self.shift, size=n) * width,
+                'angle': rng.uniform(-self.angle, self.angle, size=n),
+                'scale': rng.uniform(1 - self.zoom, 1 + self.zoom, size=n)}
+
+    def apply(self, values, deterministic=False, params=None):
+        if deterministic:
+            return values
 
-    def apply(self, values, deterministic=False):
         images = values['images']
-        for idx in range(images.shape[0]):
-            images[idx] = image_histogram_equalization(images[idx])
+        n, height, width = images.shape[:3]
+        params = self.params_for(values, params)
+
+        warped = self.pool.acquire(images.shape, images.dtype)
+        for idx in range(n):
+            matrix, offset = affine_matrix((height, width), params['angle'][idx], params['scale'][idx],
+                                           (params['y'][idx], params['x'][idx]))
+            affine(images[idx], matrix, offset, self.order, self.mode, self.cval, output=warped[idx])
+        values['images'] = warped
         return values
 
 
+class HistEq(PointwiseAugmentation):
+    """
+    Histogram equalization per image, keeping the dtype. uint8 images are mapped through lookup tables.
+    """
+
+    def transform(self, images, deterministic=False, params=None):
+        if images.dtype == np.uint8:
+            equalize_histograms(images, out=images)
+        else:
+            for idx in range(len(images)):
+                images[idx] = image_histogram_equalization(images[idx])
+
+
 class Slicer(Augmentation):
+    """
+    Cut a window of height x width (fractions of the image size) out of every image, keeping yoffset and xoffset
+    (fractions as well) away from the borders. Deterministic slicing takes the centered window and returns a view.
+    """
 
     def __init__(self, height=0.33, width=1.0, yoffset=0., xoffset=0):
         if height > 1. or width > 1.:
@@ -169,9 +226,10 @@ class Slicer(Augmentation):
         self.xoffset = xoffset
         self.yoffset = yoffset
 
-    def apply(self, values, deterministic=False):
-        images = values['images']
-        # NHWC
+    def window(self, images):
+        """
+        Window size and the offsets from the borders in pixels for a batch of NHWC images.
+        """
         image_height = images.shape[1]
         image_width = images.shape[2]
         window_height = int(self.height * image_height)
@@ -186,47 +244,66 @@ class Slicer(Augmentation):
         if image_width - 2 * xoffset_height < window_width:
             raise ValueError(
                 "Cannot fit slicing window with current xoffset specified. Lower offset value.")
+        return window_height, window_width, yoffset_height, xoffset_height
 
-        slices = []
-        for idx in range(images.shape[0]):
-            if deterministic:
-                ystart = int((image_height - 2 * yoffset_height) //
-                             2 + yoffset_height)
-                xstart = int((image_width - 2 * xoffset_height) //
-                             2 + xoffset_height)
-            else:
-                if image_height == window_height:
-                    h = 0
-                else:
-                    h = np.random.randint(
-                        image_height - 2 * yoffset_height - window_height)
-                ystart = int(h + yoffset_height)
-
-                if image_width == window_width:
-                    w = 0
-                else:
-                    w = np.random.randint(
-                        image_width - 2 * xoffset_height - window_width)
-                xstart = int(w + xoffset_height)
-            slice = images[idx, ystart:ystart +
-                           int(window_height), xstart:xstart + int(window_width)]
-            slices.append(slice[np.newaxis])
-        slices = np.concatenate(slices)
-        values['images'] = slices
+    def sample(self, values, rng):
+        images = values['images']
+        window_height, window_width, yoffset_height, xoffset_height = self.window(images)
+        n = images.shape[0]
+        return {'y': yoffset_height + rng.integers(max(images.shape[1] - 2 * yoffset_height - window_height, 1),
+                                                   size=n),
+                'x': xoffset_height + rng.integers(max(images.shape[2] - 2 * xoffset_height - window_width, 1),
+                                                   size=n)}
+
+    def apply(self, values, deterministic=False, params=None):
+        images = values['images']
+        window_height, window_width, yoffset_height, xoffset_height = self.window(images)
+
+        if deterministic:
+            # The same window for every image, a view does
+            ystart = yoffset_height + (images.shape[1] - 2 * yoffset_height - window_height) // 2
+            xstart = xoffset_height + (images.shape[2] - 2 * xoffset_height - window_width) // 2
+            values['images'] = images[:, ystart:ystart + window_height, xstart:xstart + window_width]
+            return values
+
+        params = self.params_for(values, params)
+        values['images'] = crop_batch(images, params['y'], params['x'], (window_height, window_width))
         return values
 
 
-class RescaleImages(Augmentation):
+class RescaleImages(PointwiseAugmentation):
+    """
+    Maps pixels to (pixel - offset) * scale and converts them to dtype.
+    """
 
-    def __init__(self, scale=1. / 128., offset=128.):
+    def __init__(self, scale=1. / 128., offset=128., dtype=np.float32):
         self.scale = scale
         self.offset = offset
+        self.dtype = dtype
 
-    def apply(self, values, deterministic=False):
-        images = values['images']
-        images = (images - self.offset) * self.scale
-        values['images'] = images
-        return values
+    def result_dtype(self, dtype):
+        return self.dtype
+
+    def transform(self, images, deterministic=False, params=None):
+        images -= self.offset
+        images *= self.scale
+
+
+class Cast(PointwiseAugmentation):
+    """
+    Convert images to dtype, rounding and clipping when going to integers. Marks the stage of the chain where
+    images, usually kept as uint8 through all geometric augmentations, become what the model expects.
+    Fuses with neighbouring pointwise augmentations.
+    """
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+
+    def result_dtype(self, dtype):
+        return self.dtype
+
+    def transform(self, images, deterministic=False, params=None):
+        pass
 
 
 class TopCenterCrop(Augmentation):
@@ -237,20 +314,24 @@ class TopCenterCrop(Augmentation):
     def __init__(self, crop_shape):
         self.crop_shape = crop_shape
 
-    def apply(self, values, deterministic=True):
+    def apply(self, values, deterministic=True, params=None):
 
         if deterministic == False:
             # todo random top center cropping
             raise NotImplementedError("Random resizing not yet implemented.")
 
         images = values['images']
-        for idx in range(len(images)):
-            img = images[idx]
-            orig_shape = img.shape
-            h0 = 0
-            w0 = int((orig_shape[1] - self.crop_shape[1]) * 0.5)
-            images[idx] = img[h0:h0 + self.crop_shape[0],
-                              w0:w0 + self.crop_shape[1]]
+        h, w = self.crop_shape
+        if isinstance(images, np.ndarray):
+            # A single view on the whole batch
+            w0 = int((images.shape[2] - w) * 0.5)
+            values['images'] = images[:, :h, w0:w0 + w]
+        else:
+            cropped = []
+            for img in images:
+                w0 = int((img.shape[1] - w) * 0.5)
+                cropped.append(img[:h, w0:w0 + w])
+            values['images'] = cropped
         return values
 
 
@@ -258,34 +339,63 @@ class Resize(Augmentation):
     """
     Resize images with different modes.
     Possible interpolations: 'nearest', 'lanczos', 'bilinear', 'bicubic' or 'cubic'
+    mode='resize' resizes to shape, a (rows, cols) tuple, an int percentage or a float fraction of the image size.
+    mode='width' resizes to shape columns and keeps the aspect ratio.
+    Batches of same-sized images are resized at once with cached interpolation weights, split across n_threads
+    threads if given. Images keep their dtype.
     """
 
-    def __init__(self, shape, mode='resize',interp='bicubic'):
+    def __init__(self, shape, mode='resize', interp='bicubic', n_threads=1):
+        if mode not in ('resize', 'width'):
+            raise ValueError("Resize Augmentation failed. Resize mode not known.")
         self.shape = shape
         self.interp = interp
         self.mode = mode
+        self.n_threads = n_threads
+        self.pool = BufferPool()
+        self.threads = None
+        self.threads_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['threads'] = None
+        return state
+
+    def target_size(self, image_shape):
+        rows, cols = image_shape[:2]
+        if self.mode == 'width':
+            return int(round(float(self.shape) * rows / cols)), int(self.shape)
+        if isinstance(self.shape, int):
+            return rows * self.shape // 100, cols * self.shape // 100
+        if isinstance(self.shape, float):
+            return int(rows * self.shape), int(cols * self.shape)
+        return tuple(self.shape)
+
+    def thread_pool(self):
+        # Threads do not survive fork, every worker process creates its own pool
+        if self.threads is None or self.threads_pid != os.getpid():
+            from multiprocessing.pool import ThreadPool
+            self.threads = ThreadPool(self.n_threads)
+            self.threads_pid = os.getpid()
+        return self.threads
+
+    def resize(self, images):
+        size = self.target_size(images.shape[1:])
+        resized = self.pool.acquire((len(images),) + size + images.shape[3:], images.dtype)
+        if self.n_threads > 1 and len(images) > 1:
+            bounds = np.linspace(0, len(images), min(self.n_threads, len(images)) + 1).astype(int)
+            chunks = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+            self.thread_pool().map(
+                lambda chunk: resize_batch(images[chunk], size, self.interp, out=resized[chunk]), chunks)
+        else:
+            resize_batch(images, size, self.interp, out=resized)
+        return resized
 
-    def apply(self, values, deterministic=True):
+    def apply(self, values, deterministic=True, params=None):
         # todo random resizing
         images = values['images']
-        resized = []
-        for idx in range(len(images)):
-            img = images[idx]
-
-
-            if self.mode == 'resize':
-                new_image = imresize(img, self.shape, interp=self.interp)
-            elif self.mode == 'width':
-                w, h = img.shape[:2]
-                scale = float(self.shape) / float(h)
-                desSize = map(int, [scale * w, scale * h])
-                new_image = imresize(img.squeeze(), tuple(desSize), interp=self.interp)
-            else:
-                raise Exception("Resize Augmentation failed. Resize mode not known.")
-
-            # Add batch dim
-            new_image = new_image[np.newaxis]
-            resized.append(new_image)
-
-        values["images"] = np.concatenate(resized)
+        if isinstance(images, np.ndarray) or len(set(image.shape for image in images)) == 1:
+            values['images'] = self.resize(np.asarray(images))
+        else:
+            values['images'] = [self.resize(image[np.newaxis])[0].copy() for image in images]
         return values
@@ -5,7 +5,7 @@ from .engine import Node
 from .modules.base import StreamWriter
 
 import pickle
-from scipy.misc import imsave
+from .utils import save_image
 
 try:
     import Queue
@@ -30,7 +30,7 @@ class ImgDumper(StreamWriter):
         ct = 0
         batch = stream['images']
         for item in batch:
-            imsave(self.out_dir + "/" + str(ct) + self.file_type, item)
+            save_image(self.out_dir + "/" + str(ct) + self.file_type, item)
             ct += 1
 
 
@@ -1,5 +1,12 @@
+import collections
+import copy
 import multiprocessing
+import os
+import threading
 import numpy as np
+from timeit import default_timer as timer
+
+from . import transports
 
 try:
     import Queue
@@ -11,67 +18,552 @@ import logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Per-thread worker state: the node whose worker runs in this thread, its stats row and items unpacked from bundles
+_context = threading.local()
+
+# Augmentations written against np.random still draw from numpy's global random state in thread workers, while
+# process workers are forked and reseed it with np.random.seed(). A child forked while a thread holds the lock of
+# that state would block forever in seed(), so the lock is held across fork(). The lock is a private attribute of
+# numpy's legacy RandomState, hence the defensive lookup that simply skips the hook if it ever disappears.
+# Installing the hook for the whole process is harmless: it takes an uncontended lock for the duration of fork()
+# only, which at worst delays a concurrent np.random call in another thread by that long.
+_random_lock = getattr(getattr(np.random.mtrand._rand, '_bit_generator', None), 'lock', None)
+if _random_lock is not None and hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_random_lock.acquire, after_in_parent=_random_lock.release,
+                        after_in_child=_random_lock.release)
+
+
 class Stop(Exception):
     pass
 
+
+# Item numbered in input order by an ordered node
+Sequenced = collections.namedtuple('Sequenced', ['seq', 'data'])
+
+
+class Bundle(list):
+    """
+    Several items sent as a single queue message, see Node.enqueue_many().
+    """
+    pass
+
+
+def _track_views(queue):
+    """
+    Remember that this thread consumes views from a shared memory queue.
+    """
+    views = getattr(_context, 'views', None)
+    if views is None:
+        views = _context.views = []
+    if queue not in views:
+        views.append(queue)
+
+
+def _pending(node):
+    pending = getattr(_context, 'pending', None)
+    if pending is None:
+        pending = _context.pending = {}
+    if id(node) not in pending:
+        pending[id(node)] = collections.deque()
+    return pending[id(node)]
+
+
+def _retiring():
+    retire = getattr(_context, 'retire', None)
+    return retire is not None and retire.is_set()
+
+
+def _current_row(node=None):
+    """
+    Return the stats row of the worker running in this thread, optionally only if it belongs to the given node.
+    """
+    if node is not None and getattr(_context, 'node', None) is not node:
+        return None
+    return getattr(_context, 'row', None)
+
+
+def get_rng():
+    """
+    Random generator of the worker running in this thread. Outside of workers, every thread gets its own.
+    """
+    rng = getattr(_context, 'rng', None)
+    if rng is None:
+        rng = _context.rng = np.random.default_rng()
+    return rng
+
+
+def worker_id():
+    """
+    Id of the worker running in this thread, 0 outside of workers.
+    """
+    return getattr(_context, 'worker_id', 0)
+
+
+class NodeStats(object):
+    """
+    Runtime counters of a node, shared between all of its worker processes.
+    Every worker writes into its own row so updates need no locking. Snapshots sum up all rows.
+    """
+    FIELDS = ('items_in', 'items_out', 'dequeue_time', 'enqueue_time', 'loop_time', 'loops',
+              'occupancy_sum', 'occupancy_samples', 'occupancy_max')
+    ITEMS_IN, ITEMS_OUT, DEQUEUE_TIME, ENQUEUE_TIME, LOOP_TIME, LOOPS, \
+        OCCUPANCY_SUM, OCCUPANCY_SAMPLES, OCCUPANCY_MAX = range(len(FIELDS))
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.counters = multiprocessing.RawArray('d', n_rows * len(self.FIELDS))
+
+    def rows(self):
+        return np.frombuffer(self.counters, dtype=np.float64).reshape(self.n_rows, len(self.FIELDS))
+
+    def row(self, idx):
+        return self.rows()[idx % self.n_rows]
+
+    def snapshot(self):
+        rows = self.rows()
+        totals = rows.sum(axis=0)
+        stats = dict((field, float(totals[idx])) for idx, field in enumerate(self.FIELDS))
+        stats['occupancy_max'] = float(rows[:, self.OCCUPANCY_MAX].max())
+        samples = stats.pop('occupancy_samples')
+        stats['occupancy_mean'] = stats.pop('occupancy_sum') / samples if samples else 0.
+        stats['loops'] = int(stats['loops'])
+        stats['items_in'] = int(stats['items_in'])
+        stats['items_out'] = int(stats['items_out'])
+        # Time spent in loop() that was neither waiting for input nor for space in the output queue
+        stats['work_time'] = max(0., stats['loop_time'] - stats['dequeue_time'] - stats['enqueue_time'])
+        return stats
+
+
+EXECUTORS = ('process', 'thread', 'inline')
+FANOUTS = ('broadcast', 'round_robin')
+
+
 class Node(object):
     DEFAULT_TIMEOUT = 1
 
-    def thread_proc(self, pid):
-        np.random.seed(pid)
-        self.run()
+    def thread_proc(self, pid, retire=None):
+        worker = self
+        if self.executor == 'thread':
+            # Threads share the node object. Run on a shallow copy so that state created in setup() stays
+            # private to the worker. Everything created in __init__, i.e. queues, events, counters but also caches,
+            # is shared between the threads and must be thread-safe.
+            worker = copy.copy(self)
+        else:
+            np.random.seed(pid)
+        _context.node = worker
+        _context.row = self.stats.row(pid)
+        _context.retire = retire
+        _context.worker_id = pid
+        _context.rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(pid,)))
+        try:
+            worker.run()
+        finally:
+            self.leave()
 
-    def __init__(self, n_worker=1, queue_size=128):
+    def __init__(self, n_worker=1, queue_size=128, autoscale=None, executor='process', ordered=False,
+                 reorder_window=None, fanout='broadcast', seed=None):
+        """
+        autoscale: Optional (min_worker, max_worker) tuple. If given, the pipeline adds or retires workers of this
+        node at runtime depending on the occupancy of its input and output queues.
+        executor: 'process' runs every worker in its own process. 'thread' runs workers as threads of the main
+        process and passes items by reference, which pays off for work that releases the GIL (image decoding,
+        large numpy operations). 'inline' runs no workers at all, loop() is executed on demand by whoever
+        dequeues from the node.
+        ordered: Enables dequeue_sequenced() and enqueue_sequenced() with which nodes can emit their items in
+        input order regardless of the number of workers. Items are numbered when they are taken from the input
+        and put back into order by a reorder buffer on the consumer side, which therefore must be a single process.
+        reorder_window: Maximum number of items an ordered node may run ahead of its consumer.
+        Defaults to twice the (maximum) number of workers.
+        fanout: How items are distributed if several nodes consume this one, see connect().
+        'broadcast' sends every item to all consumers, 'round_robin' every item to one of them in turn.
+        seed: Seed for the random generators of the workers (see get_rng()), which draw from independent streams.
+        Without a seed, they are seeded from fresh entropy.
+        """
+        if executor not in EXECUTORS:
+            raise ValueError("Unknown executor '%s'. Use one of %s." % (executor, ", ".join(EXECUTORS)))
+        if fanout not in FANOUTS:
+            raise ValueError("Unknown fanout '%s'. Use one of %s." % (fanout, ", ".join(FANOUTS)))
+        if autoscale is not None and executor == 'inline':
+            raise ValueError("Inline nodes have no workers to autoscale.")
         self.n_worker = n_worker
-        self.queue = multiprocessing.Queue(maxsize=queue_size)
+        self.executor = executor
+        self.autoscale = autoscale
+        if autoscale is not None:
+            min_worker, max_worker = autoscale
+            if not 1 <= min_worker <= n_worker <= max_worker:
+                raise ValueError("autoscale bounds must satisfy 1 <= min_worker <= n_worker <= max_worker.")
+        self.queue = self.make_queue(queue_size)
+        if executor == 'inline':
+            self.queue_size = 0
+        elif self.queue is queue_size:
+            self.queue_size = getattr(queue_size, 'maxsize', 0)
+        else:
+            self.queue_size = queue_size
+        self.fanout = fanout
+        self.seed = seed
+        self.outputs = [self.queue]
+        self.n_consumers = 0
+        self.cursor = 0
+        self.inline_lock = threading.Lock()
+        self.setup_pid = None
+        self.stats = NodeStats(autoscale[1] if autoscale else n_worker)
         self.lock = multiprocessing.Lock()
         self.stop = multiprocessing.Event()
+        # Number of started workers that have not exited yet, and whether one of them ran out of data
+        self.running = multiprocessing.Value('i', 0)
+        self.exhausted = multiprocessing.RawValue('b', 0)
         self.processes = []
+        self.retire_events = {}
+        self.worker_ids = {}
         self.input = None
+        self.inputs = []
+
+        self.ordered = ordered
+        if ordered:
+            self.reorder_window = reorder_window or 2 * (autoscale[1] if autoscale else n_worker)
+            self.sequence_lock = multiprocessing.Lock()
+            self.delivered_cond = multiprocessing.Condition()
+            self.seq_in = multiprocessing.RawValue('L', 0)
+            self.delivered = multiprocessing.RawValue('L', 0)
+            # Consumer side, only touched by the process that consumes this node
+            self.reorder_lock = threading.Lock()
+            self.reorder_buffer = {}
+
+    def make_queue(self, queue_size):
+        # queue_size may also be a ready-made queue such as transports.SharedMemoryQueue
+        if hasattr(queue_size, 'put') and hasattr(queue_size, 'get'):
+            return queue_size
+        if self.executor == 'process':
+            return multiprocessing.Queue(maxsize=queue_size)
+        if self.executor == 'thread':
+            return Queue.Queue(maxsize=queue_size)
+        # A single loop() may produce several items, so the inline queue must never block
+        return Queue.Queue()
 
     def attach(self, node):
-        self.input = node
+        """
+        Consume the output of node. Nodes that combine several inputs (see processing.Merge) may be attached to
+        more than one node, self.input always refers to the first one.
+        """
+        handle = node.connect()
+        if self.input is None:
+            self.input = handle
+        self.inputs.append(handle)
+
+    def connect(self):
+        """
+        Register a consumer of this node and return the object it dequeues from. The first consumer reads from
+        the node's queue. Every further consumer gets a shallow copy of the node that reads from a queue of its
+        own, which enqueue() feeds according to fanout. All consumers must be connected before the node starts.
+        """
+        self.n_consumers += 1
+        if self.n_consumers == 1:
+            return self
+        if self.ordered or self.executor == 'inline':
+            raise ValueError("%s cannot feed several consumers." % self.__class__.__name__)
+        if hasattr(self.queue, 'clone'):
+            queue = self.queue.clone()
+        elif isinstance(self.queue, Queue.Queue) or self.executor == 'process':
+            queue = self.make_queue(self.queue_size)
+        else:
+            raise ValueError("Cannot create another output queue like %r." % self.queue)
+        self.outputs.append(queue)
+        branch = copy.copy(self)
+        branch.queue = queue
+        return branch
 
     def stop_processes(self):
         self.stop.set()
 
     def dequeue(self, block=True, timeout=DEFAULT_TIMEOUT):
+        if self.ordered:
+            return self.dequeue_in_order(block, timeout)
+        return self.dequeue_next(block, timeout)
+
+    def dequeue_next(self, block=True, timeout=DEFAULT_TIMEOUT):
+        pending = _pending(self)
+        if not pending:
+            # Everything handed out before is done with, let the queue recycle its buffers
+            if hasattr(self.queue, 'release'):
+                self.queue.release()
+            if self.executor == 'inline':
+                pending.append(self.dequeue_inline())
+            else:
+                pending.append(self.get_raw(block, timeout))
+            if hasattr(self.queue, 'owns'):
+                _track_views(self.queue)
+            if isinstance(pending[0], Bundle):
+                pending.extend(pending.popleft())
+        # Accounted to the consuming node, i.e. the one whose worker runs in this thread
+        row = _current_row()
+        if row is not None:
+            row[NodeStats.ITEMS_IN] += 1
+        return pending.popleft()
+
+    def dequeue_many(self, n, block=True, timeout=DEFAULT_TIMEOUT):
+        """
+        Return a list of up to n items. Blocks for the first one only and adds whatever else is available
+        without waiting.
+        """
+        items = [self.dequeue(block, timeout)]
+        pending = _pending(self)
+        while len(items) < n:
+            if not pending:
+                try:
+                    val = self.queue.get(False)
+                except Queue.Empty:
+                    break
+                pending.extend(val if isinstance(val, Bundle) else (val,))
+            items.append(self.dequeue())
+        return items
+
+    def get_raw(self, block=True, timeout=DEFAULT_TIMEOUT):
+        row = _current_row()
+        s = timer()
         while True:
             try:
                 val = self.queue.get(block=block, timeout=timeout)
                 break
             except Queue.Empty:
-                if self.stop.is_set():
+                if not block:
+                    raise
+                if self.stop.is_set() or _retiring():
                     raise Stop()
+        if row is not None:
+            row[NodeStats.DEQUEUE_TIME] += timer() - s
         return val
 
+    def enqueue_many(self, items, block=True, timeout=DEFAULT_TIMEOUT):
+        """
+        Send several items as one queue message. Consumers still receive them one by one from dequeue().
+        """
+        if items:
+            self.enqueue(Bundle(items), block, timeout)
+
     def enqueue(self, data, block=True, timeout=DEFAULT_TIMEOUT):
+        views = getattr(_context, 'views', None)
+        if views and not hasattr(self.queue, 'owns'):
+            # Queues that do not copy synchronously would otherwise still reference input slots after they have
+            # been recycled by the next dequeue
+            data = transports.detach(data, views)
+        row = _current_row(self)
+        s = timer()
+        if len(self.outputs) == 1:
+            self.put(self.queue, data, block, timeout)
+        elif self.fanout == 'broadcast':
+            items = [data] * len(self.outputs)
+            if isinstance(self.queue, Queue.Queue):
+                # Consumers modify items in place, so in-process queues must not share them. All copies are made
+                # before the first consumer can touch the item, the last queue gets the original.
+                items[:-1] = [transports.detach(data) for _ in self.outputs[:-1]]
+            for queue, item in zip(self.outputs, items):
+                self.put(queue, item, block, timeout)
+        else:
+            self.put_round_robin(data, block, timeout)
+        if row is not None:
+            row[NodeStats.ENQUEUE_TIME] += timer() - s
+            row[NodeStats.ITEMS_OUT] += len(data) if isinstance(data, Bundle) else 1
+            self.record_occupancy(row)
+
+    def put(self, queue, data, block=True, timeout=DEFAULT_TIMEOUT):
         while True:
             try:
-                self.queue.put(data, block, timeout=timeout)
+                queue.put(data, block, timeout=timeout)
                 break
             except Queue.Full:
+                if not block:
+                    raise
                 if self.stop.is_set():
                     raise Stop()
 
+    def put_round_robin(self, data, block=True, timeout=DEFAULT_TIMEOUT):
+        """
+        Put data into the next output queue in turn, skipping queues that are full right now.
+        """
+        start = self.cursor
+        n_outputs = len(self.outputs)
+        self.cursor = (start + 1) % n_outputs
+        for offset in range(n_outputs):
+            try:
+                self.outputs[(start + offset) % n_outputs].put(data, False)
+                return
+            except Queue.Full:
+                continue
+        self.put(self.outputs[start], data, block, timeout)
+
+    def occupancy(self):
+        """
+        Fill level of the output queue between 0 and 1 or None if it cannot be determined.
+        """
+        if not self.queue_size:
+            return None
+        try:
+            return float(self.queue.qsize()) / self.queue_size
+        except NotImplementedError:
+            # qsize() is not available on all platforms (e.g. macOS)
+            return None
+
+    def record_occupancy(self, row):
+        occupancy = self.occupancy()
+        if occupancy is None:
+            return
+        row[NodeStats.OCCUPANCY_SUM] += occupancy
+        row[NodeStats.OCCUPANCY_SAMPLES] += 1
+        row[NodeStats.OCCUPANCY_MAX] = max(row[NodeStats.OCCUPANCY_MAX], occupancy)
+
+    def dequeue_sequenced(self):
+        """
+        Dequeue the next item from the input and number it in input order. Waits while the node is more than
+        reorder_window items ahead of its consumer.
+        """
+        with self.sequence_lock:
+            with self.delivered_cond:
+                while self.seq_in.value >= self.delivered.value + self.reorder_window:
+                    self.delivered_cond.wait(self.DEFAULT_TIMEOUT)
+                    if self.stop.is_set() or _retiring():
+                        raise Stop()
+            values = self.input.dequeue()
+            seq = self.seq_in.value
+            self.seq_in.value += 1
+        return seq, values
+
+    def enqueue_sequenced(self, seq, data):
+        """
+        Enqueue an item numbered by dequeue_sequenced().
+        """
+        self.enqueue(Sequenced(seq, data))
+
+    def dequeue_in_order(self, block=True, timeout=DEFAULT_TIMEOUT):
+        """
+        Return the items of an ordered node by sequence number, buffering those that arrive early.
+        """
+        with self.reorder_lock:
+            expected = self.delivered.value
+            while expected not in self.reorder_buffer:
+                item = self.dequeue_next(block, timeout)
+                if item.seq == expected:
+                    self.reorder_buffer[item.seq] = item.data
+                else:
+                    # Kept across dequeues, so it must not point into recycled transport buffers
+                    views = [self.queue] if hasattr(self.queue, 'owns') else []
+                    self.reorder_buffer[item.seq] = transports.detach(item.data, views)
+            data = self.reorder_buffer.pop(expected)
+            with self.delivered_cond:
+                self.delivered.value = expected + 1
+                self.delivered_cond.notify_all()
+        return data
+
+    def dequeue_inline(self):
+        """
+        Run loop() in the calling thread until an item is available. The node is set up once per process.
+        """
+        with self.inline_lock:
+            previous = (getattr(_context, 'node', None), getattr(_context, 'row', None))
+            _context.node, _context.row = self, self.stats.row(0)
+            try:
+                if self.setup_pid != os.getpid():
+                    self.setup()
+                    self.setup_pid = os.getpid()
+                while self.queue.empty():
+                    if self.stop.is_set():
+                        raise Stop()
+                    s = timer()
+                    self.loop()
+                    _context.row[NodeStats.LOOP_TIME] += timer() - s
+                    _context.row[NodeStats.LOOPS] += 1
+            finally:
+                _context.node, _context.row = previous
+            return self.queue.get_nowait()
+
     def start_daemons(self):
+        if self.executor == 'inline':
+            return
         for pid in range(self.n_worker):
-            p = multiprocessing.Process(target=self.thread_proc, args=(pid,))
-            p.daemon = True
-            self.processes.append(p)
-            p.start()
+            self.start_worker(pid)
+
+    def start_worker(self, pid):
+        if self.executor == 'thread':
+            retire = threading.Event()
+            p = threading.Thread(target=self.thread_proc, args=(pid, retire))
+        else:
+            retire = multiprocessing.Event()
+            p = multiprocessing.Process(target=self.thread_proc, args=(pid, retire))
+        p.daemon = True
+        self.processes.append(p)
+        self.retire_events[p] = retire
+        self.worker_ids[p] = pid
+        with self.running.get_lock():
+            self.running.value += 1
+        p.start()
+
+    def live_workers(self):
+        return [p for p in self.processes if p.is_alive() and not self.retire_events[p].is_set()]
+
+    def add_worker(self):
+        """
+        Start one more worker with the lowest worker id that no running worker holds, including retiring ones.
+        Ids stay below the maximum number of workers, so that every worker keeps its own row of the shared
+        counters. Returns False and starts nothing if all ids are taken.
+        """
+        for p in self.processes:
+            if not p.is_alive():
+                del self.retire_events[p]
+                del self.worker_ids[p]
+        self.processes = [p for p in self.processes if p.is_alive()]
+        free = set(range(self.stats.n_rows)) - set(self.worker_ids.values())
+        if not free:
+            return False
+        self.start_worker(min(free))
+        self.n_worker = len(self.live_workers())
+        return True
+
+    def retire_worker(self):
+        """
+        Ask the most recently started worker to exit. It finishes its current item and leaves once it runs
+        out of input or completes its loop.
+        """
+        workers = self.live_workers()
+        if len(workers) > 1:
+            self.retire_events[workers[-1]].set()
+        self.n_worker = len(self.live_workers())
 
     def run(self):
         self.setup()
+        row = _current_row(self)
         while True:
             try:
+                s = timer()
                 self.loop()
-                if self.stop.is_set():
+                if row is not None:
+                    row[NodeStats.LOOP_TIME] += timer() - s
+                    row[NodeStats.LOOPS] += 1
+                if self.stop.is_set() or _retiring():
                     break
             except Stop:
+                if not (self.stop.is_set() or _retiring()):
+                    # Neither stopped nor retired: the worker ran out of data for good. Sources raise Stop from
+                    # loop() when they have no more data, consumers when their input is exhausted.
+                    self.exhausted.value = 1
                 break
         self.close()
 
+    def leave(self):
+        """
+        Account for an exiting worker. Once the last one has left and one of them ran out of data, the node stops,
+        so that its consumers receive Stop as soon as they have drained its queue and finish in turn.
+        """
+        if self.exhausted.value and self.executor == 'process':
+            # Flush items still held by the feeder threads of multiprocessing queues before consumers see the stop
+            for queue in self.outputs:
+                queue = getattr(queue, 'ready', queue)
+                if hasattr(queue, 'join_thread'):
+                    queue.close()
+                    queue.join_thread()
+        with self.running.get_lock():
+            self.running.value -= 1
+            if self.running.value == 0 and self.exhausted.value:
+                self.stop.set()
+
     def setup(self):
         pass
 
@@ -82,23 +574,309 @@ class Node(object):
         raise NotImplementedError("Implement loop() in your node")
 
 
-class Pipeline(object):
+class Autoscaler(threading.Thread):
+    """
+    Periodically adjusts the number of workers of all nodes with autoscaling enabled.
+    A node whose input queue fills up while its output queue is drained is the bottleneck and gets another worker.
+    A node that is starved for input or whose consumers cannot keep up loses one.
+    Queue occupancies are smoothed with an exponential moving average to avoid flapping.
+    """
 
-    def __init__(self, nodes):
-        self.nodes = nodes
-        for idx in range(1, len(nodes)):
-            self.nodes[idx].attach(self.nodes[idx - 1])
+    def __init__(self, nodes, interval=1., high=0.75, low=0.25, smoothing=0.5):
+        super(Autoscaler, self).__init__()
+        self.daemon = True
+        self.nodes = [node for node in nodes if node.autoscale]
+        self.interval = interval
+        self.high = high
+        self.low = low
+        self.smoothing = smoothing
+        self.done = threading.Event()
+        self.levels = {}
+
+    def smoothed(self, node):
+        occupancy = node.occupancy()
+        if occupancy is None:
+            return None
+        level = self.levels.get(node, occupancy)
+        level = self.smoothing * level + (1 - self.smoothing) * occupancy
+        self.levels[node] = level
+        return level
+
+    def decide(self, input_level, output_level):
+        """
+        Return +1 to add a worker, -1 to retire one and 0 to keep the current number.
+        Nodes without input (sources) are judged by their output queue alone.
+        """
+        if output_level > self.high:
+            return -1
+        if input_level is None:
+            return 1 if output_level < self.low else 0
+        if input_level > self.high:
+            return 1
+        if input_level < self.low and output_level < self.low:
+            return -1
+        return 0
+
+    def step(self):
+        for node in self.nodes:
+            output_level = self.smoothed(node)
+            input_level = self.smoothed(node.input) if node.input is not None else None
+            if output_level is None:
+                continue
+            min_worker, max_worker = node.autoscale
+            action = self.decide(input_level, output_level)
+            if action > 0 and node.n_worker < max_worker:
+                node.add_worker()
+                logger.info("Autoscaler: %s scaled up to %d workers", node.__class__.__name__, node.n_worker)
+            elif action < 0 and node.n_worker > min_worker:
+                node.retire_worker()
+                logger.info("Autoscaler: %s scaled down to %d workers", node.__class__.__name__, node.n_worker)
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.step()
+
+    def stop(self):
+        self.done.set()
+
+
+class Prefetcher(threading.Thread):
+    """
+    Background thread that keeps up to depth batches of a graph ready, so that fetching the next batch overlaps with
+    whatever the caller does with the current one. Iterating stops once the graph is stopped.
+    """
+
+    def __init__(self, graph, node=None, depth=2):
+        super(Prefetcher, self).__init__()
+        self.daemon = True
+        self.graph = graph
+        self.node = node
+        self.batches = Queue.Queue(maxsize=max(1, depth))
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            try:
+                item = (self.graph.fetch(self.node), None)
+            except Exception as e:
+                item = (None, e)
+            while not self.done.is_set():
+                try:
+                    self.batches.put(item, timeout=Node.DEFAULT_TIMEOUT)
+                    break
+                except Queue.Full:
+                    pass
+            if item[1] is not None:
+                break
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                batch, error = self.batches.get(timeout=Node.DEFAULT_TIMEOUT)
+                break
+            except Queue.Empty:
+                if self.done.is_set() or not self.is_alive():
+                    raise StopIteration()
+        if isinstance(error, Stop):
+            self.done.set()
+            raise StopIteration()
+        if error is not None:
+            self.done.set()
+            raise error
+        return batch
+
+    next = __next__
+
+    def close(self):
+        self.done.set()
+
+
+class Graph(object):
+    """
+    Nodes connected as a directed acyclic graph. A node may feed several consumers (see Node.fanout) and nodes
+    such as processing.Merge combine several inputs, so decoding or caching work can be shared between branches:
+
+        graph = Graph()
+        reader = graph.add(ClfImgReader(data_dir, 32, (240, 320)))
+        train = graph.add(Augmentations([FlipX()]), inputs=[reader])
+        val = graph.add(Augmentations(deterministic=True), inputs=[reader])
+        graph.start()
+        batch = graph.dequeue(node=train)
+
+    Nodes must be added after their inputs.
+    """
+
+    def __init__(self, autoscale_interval=1.):
+        self.nodes = []
+        self.edges = []
+        self.autoscale_interval = autoscale_interval
+        self.autoscaler = None
+
+    def add(self, node, inputs=()):
+        for input_node in inputs:
+            if input_node not in self.nodes:
+                raise ValueError("Add %s to the graph before using it as an input." % input_node.__class__.__name__)
+            node.attach(input_node)
+            self.edges.append((input_node, node))
+        self.nodes.append(node)
+        return node
+
+    def consumers(self, node):
+        return [consumer for producer, consumer in self.edges if producer is node]
+
+    def sinks(self):
+        return [node for node in self.nodes if not self.consumers(node)]
+
+    def start(self):
+        self.check_executors()
         # Run nodes
         for node in self.nodes:
             node.start_daemons()
 
-    def dequeue(self, block=True):
-        value = self.nodes[-1].dequeue(block)
+        if any(node.autoscale for node in self.nodes):
+            self.autoscaler = Autoscaler(self.nodes, interval=self.autoscale_interval)
+            self.autoscaler.start()
+        return self
+
+    def sink(self):
+        sinks = self.sinks()
+        if len(sinks) != 1:
+            raise ValueError("The graph has %d sinks, specify which node to dequeue from." % len(sinks))
+        return sinks[0]
+
+    def consuming_nodes(self, node):
+        """
+        Nodes whose workers consume the output of node. Inline nodes are looked through since they run in their
+        consumers. None stands for the main process.
+        """
+        consumers = self.consumers(node)
+        if not consumers:
+            return [None]
+        result = []
+        for consumer in consumers:
+            if consumer.executor == 'inline':
+                result.extend(self.consuming_nodes(consumer))
+            else:
+                result.append(consumer)
+        return result
+
+    def check_executors(self):
+        """
+        Thread nodes hand out items through in-process queues, so whoever consumes them (possibly through a chain
+        of inline nodes) must run in the main process as well. Ordered nodes reorder their items on the consumer
+        side, which is why that must be a single process.
+        """
+        for node in self.nodes:
+            for consumer in self.consuming_nodes(node):
+                if consumer is None or consumer.executor != 'process':
+                    continue
+                if node.executor == 'thread':
+                    raise ValueError("%s runs in threads and cannot feed the worker processes of %s." % (
+                        node.__class__.__name__, consumer.__class__.__name__))
+                if node.ordered and (consumer.n_worker > 1 or consumer.autoscale):
+                    raise ValueError(
+                        "%s is ordered and must be consumed by a single process, but %s runs %d workers." % (
+                            node.__class__.__name__, consumer.__class__.__name__, consumer.n_worker))
+
+    def dequeue(self, block=True, node=None):
+        """
+        Dequeue from node, which defaults to the only sink of the graph.
+        """
+        node = node or self.sink()
+        value = node.dequeue(block)
         if value is None:
             raise TypeError(
                 "None type returned by pipeline. Are your nodes running?")
         return value
 
+    def fetch(self, node=None):
+        """
+        Dequeue a batch that stays valid across further dequeues, e.g. from another thread. Arrays that live in
+        slots of a SharedMemoryQueue are copied out and the slots are released right away.
+        """
+        node = node or self.sink()
+        value = self.dequeue(True, node)
+        if hasattr(node.queue, 'owns'):
+            value = transports.detach(value, [node.queue])
+            node.queue.release()
+        return value
+
+    def iterate(self, node=None, prefetch=2):
+        """
+        Iterate over the batches of node while a background thread prefetches up to prefetch batches:
+
+            for batch in graph.iterate(prefetch=4):
+                train(batch)
+        """
+        prefetcher = Prefetcher(self, node or self.sink(), prefetch)
+        prefetcher.start()
+        return prefetcher
+
+    def __iter__(self):
+        return self.iterate()
+
+    def next_batch(self, node=None, loop=None):
+        """
+        Awaitable for the next batch of node, fetched in the default executor of the event loop:
+
+            batch = await graph.next_batch()
+
+        Without a loop, it must be called from a coroutine running in the event loop.
+        """
+        import asyncio
+        loop = loop or asyncio.get_running_loop()
+        return loop.run_in_executor(None, self.fetch, node or self.sink())
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(None, self.fetch_async, self.sink())
+
+    def fetch_async(self, node):
+        try:
+            return self.fetch(node)
+        except Stop:
+            raise StopAsyncIteration()
+
     def stop(self):
+        if self.autoscaler is not None:
+            self.autoscaler.stop()
         for node in self.nodes:
             node.stop_processes()
+
+    def stats(self):
+        """
+        Snapshot of the runtime counters of all nodes, in the order they were added. Times are seconds summed over
+        all workers.
+        A starved stage spends most of its loop time in dequeue_time, a stage whose consumers are too slow in
+        enqueue_time with an output queue occupancy close to 1.
+        """
+        snapshots = []
+        for node in self.nodes:
+            stats = node.stats.snapshot()
+            stats['node'] = node.__class__.__name__
+            stats['n_worker'] = node.n_worker
+            stats['queue_size'] = node.queue_size
+            snapshots.append(stats)
+        return snapshots
+
+
+class Pipeline(Graph):
+    """
+    Linear chain of nodes, each one consuming the output of the previous. The nodes start right away.
+    """
+
+    def __init__(self, nodes, autoscale_interval=1.):
+        super(Pipeline, self).__init__(autoscale_interval)
+        for idx, node in enumerate(nodes):
+            self.add(node, inputs=[nodes[idx - 1]] if idx > 0 else [])
+        self.start()
+
+    def dequeue(self, block=True, node=None):
+        return super(Pipeline, self).dequeue(block, node or self.nodes[-1])
@@ -1,8 +1,5 @@
-import plyvel
 from ..engine import Node
-import msgpack
 import numpy as np
-import msgpack_numpy as npack
 
 try:
     import Queue
@@ -10,7 +7,7 @@ except:
     import queue as Queue
 
 class LevelDBSource(Node):
-    def __init__(self, filename, batch_size=32, decoding=npack.decode):
+    def __init__(self, filename, batch_size=32, decoding=None):
         self.filename = filename
         self.batch_size = batch_size
         self.decoding = decoding
@@ -18,13 +15,19 @@ class LevelDBSource(Node):
         super(LevelDBSource, self).__init__(n_worker=1)
 
     def setup(self):
+        import plyvel
+        import msgpack
+        import msgpack_numpy as npack
+        self.msgpack = msgpack
+        if self.decoding is None:
+            self.decoding = npack.decode
         self.db = plyvel.DB(self.filename, create_if_missing=False)
 
     def loop(self):
         samples = 0
         result_dict = {}
         for _, sample in self.db:
-            sample = msgpack.unpackb(sample, object_hook=self.decoding)
+            sample = self.msgpack.unpackb(sample, object_hook=self.decoding)
 
             for key in sample:
                 if key not in result_dict:
@@ -47,13 +50,19 @@ class LevelDBSource(Node):
 
 
 class LevelDBSink(Node):
-    def __init__(self, filename, encoding=npack.encode):
+    def __init__(self, filename, encoding=None):
         self.filename = filename
         self.encoding = encoding
         self.global_idx = 0
         super(LevelDBSink, self).__init__(n_worker=1)
 
     def setup(self):
+        import plyvel
+        import msgpack
+        import msgpack_numpy as npack
+        self.msgpack = msgpack
+        if self.encoding is None:
+            self.encoding = npack.encode
         self.db = plyvel.DB(self.filename, create_if_missing=True)
 
     def loop(self):
@@ -64,7 +73,7 @@ class LevelDBSink(Node):
             sample = {}
             for key in data:
                 sample[key] = data[key][idx]
-            serialized = msgpack.packb(sample, default=self.encoding)
+            serialized = self.msgpack.packb(sample, default=self.encoding)
             self.db.put(bytes(self.global_idx), serialized)
             self.global_idx += 1
 
@@ -1,21 +1,85 @@
 import numpy as np
 
-from scipy.misc import imsave
-
 from .base import StreamWriter
-from ..engine import Node
-from ..utils import get_directory_filenames, load_image, get_class_file_map, FIFOCache
+from ..engine import Node, Stop, get_rng, worker_id
+from ..utils import get_directory_filenames, load_image, save_image, get_class_file_map, \
+    BufferPool, ByteBudgetCache, EncodedImageCache, FIFOCache, SharedArrayCache, shard_indices, shuffled_stream
 from ..constants import IMAGE_FILETYPES
 
 
+def check_sharding(n_files, n_worker, shuffle_buffer):
+    if n_files < n_worker:
+        raise ValueError("Cannot shard %d files over %d workers." % (n_files, n_worker))
+    if shuffle_buffer < 1:
+        raise ValueError("The shuffle buffer needs to hold at least one image.")
+
+
+CACHE_MODES = ('decoded', 'encoded')
+
+
+def make_cache(cache_size, cache_bytes, cache_policy, n_worker, cache_mode='decoded', shape=None,
+               decoded_cache_bytes=None):
+    """
+    A cache of cache_size items, or of cache_bytes bytes evicted by cache_policy if given.
+    In 'encoded' mode, an EncodedImageCache of cache_bytes (1 GB by default) with an optional decoded tier.
+    """
+    if cache_mode not in CACHE_MODES:
+        raise ValueError("Unknown cache mode '%s'. Use one of %s." % (cache_mode, ", ".join(CACHE_MODES)))
+    if cache_mode == 'encoded':
+        if cache_bytes is None:
+            cache_bytes = 1 << 30
+        return EncodedImageCache(cache_bytes, shape, cache_policy, decoded_cache_bytes, n_rows=n_worker)
+    if cache_bytes is None:
+        return FIFOCache(cache_size)
+    return ByteBudgetCache(cache_bytes, cache_policy, n_rows=n_worker)
+
+
+def cached_image(cache, key, filename, shape):
+    """
+    Load the image of filename through cache, see make_cache().
+    """
+    if isinstance(cache, EncodedImageCache):
+        return cache.load(key, filename)
+    image = cache.get(key)
+    if image is None:
+        image = load_image(filename, shape)
+        cache.set(key, image)
+    return image
+
+
+def sharded_stream(n_files, load, shard_size, shuffle_buffer, n_worker, once=False):
+    """
+    Stream of (index, image) over the shards of the calling worker. Shards shrink if needed so that every
+    worker gets at least one.
+    """
+    shard_size = max(1, min(shard_size, n_files // n_worker))
+    shards = shard_indices(n_files, shard_size, worker_id(), n_worker)
+    return shuffled_stream(shards, load, shuffle_buffer, get_rng(), once)
+
+
 class ClfImgReader(Node):
     """
     Imagefile reader to stream classification data from a set of folders whose names are used as classes.
+    Images are fitted to shape (rows, cols). Large JPEGs are decoded at reduced resolution for that.
     Operations are random.
     TODO: Deterministic read in, add keys before the imgs are put on the queue for later (debug) identification
     """
 
-    def __init__(self, data_dir, batch_size, shape, file_map=None, cache_size=10000):
+    def __init__(self, data_dir, batch_size, shape, file_map=None, cache_size=10000, executor='process',
+                 sharded=False, shard_size=64, shuffle_buffer=1024, n_worker=1, shared_cache=None,
+                 cache_bytes=None, cache_policy='lru', cache_mode='decoded', decoded_cache_bytes=None):
+        """
+        sharded: Instead of drawing a random class and file for every sample, split all files into shards of
+        shard_size files, deal them to the workers and read every shard sequentially. Samples are mixed through
+        a buffer of shuffle_buffer decoded images. Every file is read exactly once per epoch.
+        With several workers, each one draws its random samples from its own part of every class.
+        shared_cache: Keep up to cache_size decoded RGB images in one cache shared by all worker processes
+        instead of a private cache per worker. Enabled by default for several worker processes.
+        cache_bytes: Bound the cache by memory instead of cache_size. Private caches then evict by cache_policy
+        (see ByteBudgetCache), a shared cache holds as many images as fit.
+        cache_mode: 'encoded' caches the file contents instead and decodes them on every hit, with a second tier
+        of decoded_cache_bytes for decoded images if given. See EncodedImageCache.
+        """
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.shape = shape
@@ -24,37 +88,90 @@ class ClfImgReader(Node):
         if not self.file_map:
             self.file_map, self.n_classes, self.classes = get_class_file_map(
                 self.data_dir)
+        else:
+            self.classes = sorted(self.file_map)
+            self.n_classes = len(self.classes)
 
-        self.cache = FIFOCache(cache_size)
+        self.pool = BufferPool()
 
-        super(ClfImgReader, self).__init__()
+        self.sharded = sharded
+        self.shard_size = shard_size
+        self.shuffle_buffer = shuffle_buffer
+        self.samples = [(cls_index, filename) for cls_index, cls in enumerate(self.classes)
+                        for filename in sorted(self.file_map[cls])]
+        if sharded:
+            check_sharding(len(self.samples), n_worker, shuffle_buffer)
+        self.stream = None
+        self.partition = None
+
+        if shared_cache is None:
+            shared_cache = n_worker > 1 and executor == 'process' and cache_mode == 'decoded'
+        if shared_cache and cache_mode != 'decoded':
+            raise ValueError("Only decoded images can be cached across processes.")
+        if shared_cache:
+            slot_size = shape[0] * shape[1] * 3
+            if cache_bytes is not None:
+                cache_size = cache_bytes // slot_size
+            self.cache = SharedArrayCache(len(self.samples), cache_size, slot_size)
+        else:
+            self.cache = make_cache(cache_size, cache_bytes, cache_policy, n_worker, cache_mode, shape,
+                                    decoded_cache_bytes)
+
+        super(ClfImgReader, self).__init__(executor=executor, n_worker=n_worker)
+
+    def load(self, sample):
+        return cached_image(self.cache, sample, self.data_dir + "/" + self.samples[sample][1], self.shape)
+
+    def class_partition(self):
+        """
+        Sample indices of every class that the calling worker draws from. Classes with fewer files than workers
+        are not split.
+        """
+        worker, start = worker_id(), 0
+        partition = []
+        for cls in self.classes:
+            indices = np.arange(start, start + len(self.file_map[cls]))
+            start += len(indices)
+            if len(indices) >= self.n_worker:
+                indices = indices[worker % self.n_worker::self.n_worker]
+            partition.append(indices)
+        return partition
+
+    def random_samples(self):
+        if self.partition is None:
+            self.partition = self.class_partition()
+        rng = get_rng()
+        cls_indices = rng.integers(self.n_classes, size=self.batch_size)
+        choices = rng.random(self.batch_size)
+        for idx in range(self.batch_size):
+            # Load a random sample from that class
+            indices = self.partition[cls_indices[idx]]
+            sample = indices[int(choices[idx] * len(indices))]
+            yield sample, self.load(sample)
+
+    def sharded_samples(self):
+        if self.stream is None:
+            self.stream = sharded_stream(len(self.samples), self.load, self.shard_size, self.shuffle_buffer,
+                                         self.n_worker)
+        for _ in range(self.batch_size):
+            yield next(self.stream)
 
     def loop(self):
-        labels = []
-        images = []
+        images = None
+        labels = self.pool.acquire((self.batch_size, self.n_classes), np.float32)
+        labels.fill(0)
         keys = []
-        for idx in range(self.batch_size):
-            cls_index = np.random.randint(self.n_classes)
-            one_hot = np.zeros((1, self.n_classes), dtype=np.float32)
-            one_hot[0, cls_index] = 1.
+        samples = self.sharded_samples() if self.sharded else self.random_samples()
+        for idx, (sample, image) in enumerate(samples):
+            cls_index, filename = self.samples[sample]
+            labels[idx, cls_index] = 1.
+            filename = self.data_dir + "/" + filename
 
-            # Load a random sample from that class
-            files = self.file_map[self.classes[cls_index]]
-            filename = self.data_dir + "/" + \
-                files[np.random.randint(len(files))]
-
-            image = self.cache.get(filename)
-            if not image:
-                image = load_and_fit_image(
-                    filename, self.shape)[np.newaxis]
-                self.cache.set(filename, image)
-
-            labels.append(one_hot)
-            images.append(image)
+            if images is None:
+                images = self.pool.acquire((self.batch_size,) + image.shape, image.dtype)
+            images[idx] = image
             keys.append(filename)
 
-        images = np.concatenate(images)
-        labels = np.concatenate(labels)
         keys = np.array(keys)
         self.enqueue({'images': images,
                         'labels': labels,
@@ -65,42 +182,83 @@ class ImgReader(Node):
     """
     Reads (random) images in a directory and puts them onto the queue unaltered as numpy arrays.
     The batch size defines how many images are put into the queue in one slot.
+    With a shape (rows, cols), images are decoded at reduced resolution and fitted to it instead, and the batch is
+    a single array.
+    With sharded=True, files are read shard by shard and mixed through a shuffle buffer, see ClfImgReader. With
+    once=True, every worker stops after one epoch over its shards, and consumers receive Stop once all did.
+    With cache_bytes, the cache is bounded by memory and evicts by cache_policy, see ByteBudgetCache.
+    cache_mode='encoded' caches file contents instead of decoded images, see ClfImgReader.
     """
 
-    def __init__(self, data_dir, batch_size=32, random=True, once=False, cache_size=100):
+    def __init__(self, data_dir, batch_size=32, random=True, once=False, cache_size=100, executor='process',
+                 shape=None, sharded=False, shard_size=64, shuffle_buffer=1024, n_worker=1, cache_bytes=None,
+                 cache_policy='lru', cache_mode='decoded', decoded_cache_bytes=None):
         self.data_dir = data_dir
         self.batch_size = batch_size
+        self.shape = shape
         self.random = random
         self.once = once
-        self.cache = FIFOCache(cache_size)
-        self.filenames = get_directory_filenames(self.data_dir, IMAGE_FILETYPES)
+        self.cache = make_cache(cache_size, cache_bytes, cache_policy, n_worker, cache_mode, shape,
+                                decoded_cache_bytes)
+        self.filenames = sorted(get_directory_filenames(self.data_dir, IMAGE_FILETYPES))
         self.n_files = len(self.filenames)
         self.gc = 0
-        super(ImgReader, self).__init__()
+        self.sharded = sharded
+        self.shard_size = shard_size
+        self.shuffle_buffer = shuffle_buffer
+        if sharded:
+            check_sharding(self.n_files, n_worker, shuffle_buffer)
+        self.stream = None
+        super(ImgReader, self).__init__(executor=executor, n_worker=n_worker)
+
+    def load(self, idx):
+        return cached_image(self.cache, idx, self.data_dir + "/" + self.filenames[idx], self.shape)
 
     def loop(self):
+        if self.sharded:
+            return self.loop_sharded()
         payload = []
         indexes = []
+        if self.random:
+            random_indexes = get_rng().integers(self.n_files, size=self.batch_size)
 
         for bct in range(self.batch_size):
             if self.random:
-                idx = np.random.randint(self.n_files)
+                idx = random_indexes[bct]
             else:
                 if self.gc > self.n_files - 1:
                     if self.once:
-                        return
+                        break
                     self.gc = 0
 
                 idx = self.gc
                 self.gc += 1
-            img = self.cache.get(idx)
-            if img is None:
-                img = load_image(self.data_dir + "/" + self.filenames[idx])
-                self.cache.set(idx, img)
 
+            payload.append(self.load(idx))
+            indexes.append(idx)
+
+        if not payload:
+            raise Stop()
+        self.emit(payload, indexes)
+
+    def loop_sharded(self):
+        if self.stream is None:
+            self.stream = sharded_stream(self.n_files, self.load, self.shard_size, self.shuffle_buffer,
+                                         self.n_worker, self.once)
+        payload = []
+        indexes = []
+        for idx, img in self.stream:
             payload.append(img)
             indexes.append(idx)
+            if len(payload) == self.batch_size:
+                break
+        if not payload:
+            raise Stop()
+        self.emit(payload, indexes)
 
+    def emit(self, payload, indexes):
+        if self.shape is not None:
+            payload = np.stack(payload)
         self.enqueue({'images': payload, 'keys': indexes})
 
 
@@ -118,4 +276,4 @@ class ImgSaver(StreamWriter):
         batch = stream['images']
         keys = stream['keys']
         for item, key in zip(batch, keys):
-            imsave(self.out_dir + "/" + str(key) + self.file_type, item)
+            save_image(self.out_dir + "/" + str(key) + self.file_type, item)
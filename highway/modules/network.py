@@ -1,6 +1,3 @@
-import msgpack
-import msgpack_numpy as npack
-import zmq
 from ..engine import Node
 
 try:
@@ -11,7 +8,7 @@ except:
 
 class ZMQSink(Node):
 
-    def __init__(self, target, bind=True, encoding=npack.encode, flags=0):
+    def __init__(self, target, bind=True, encoding=None, flags=0):
         self.target = target
         self.bind = bind
         self.encoding = encoding
@@ -19,6 +16,12 @@ class ZMQSink(Node):
         super(ZMQSink, self).__init__(n_worker=1)
 
     def setup(self):
+        import zmq
+        import msgpack
+        import msgpack_numpy as npack
+        self.msgpack = msgpack
+        if self.encoding is None:
+            self.encoding = npack.encode
         self.ctx = zmq.Context()
         self.socket = self.ctx.socket(zmq.PUSH)
 
@@ -31,7 +34,7 @@ class ZMQSink(Node):
         values = self.input.dequeue()
         if values is not None:
             # Send values ZMQ
-            serialized = msgpack.packb(
+            serialized = self.msgpack.packb(
                 values, default=self.encoding, use_bin_type=True)
             result = self.socket.send(serialized, flags=self.flags)
 
@@ -41,7 +44,7 @@ class ZMQSink(Node):
 
 class ZMQSource(Node):
 
-    def __init__(self, source, bind=False, decoding=npack.decode, flags=0, copy=True, track=False):
+    def __init__(self, source, bind=False, decoding=None, flags=0, copy=True, track=False):
         self.source = source
         self.bind = bind
         self.decoding = decoding
@@ -51,6 +54,12 @@ class ZMQSource(Node):
         super(ZMQSource, self).__init__(n_worker=1)
 
     def setup(self):
+        import zmq
+        import msgpack
+        import msgpack_numpy as npack
+        self.msgpack = msgpack
+        if self.decoding is None:
+            self.decoding = npack.decode
         self.ctx = zmq.Context()
         self.socket = self.ctx.socket(zmq.PULL)
         if self.bind:
@@ -61,7 +70,7 @@ class ZMQSource(Node):
     def loop(self):
         serialized = self.socket.recv(
             flags=self.flags, copy=self.copy, track=self.track)
-        values = msgpack.unpackb(
+        values = self.msgpack.unpackb(
             serialized, object_hook=self.decoding, encoding='utf-8')
         if values is not None:
             self.enqueue(values)
@@ -1,50 +1,331 @@
+import multiprocessing
+import time
 import numpy as np
-from ..engine import Node
+from timeit import default_timer as timer
+from .. import transports
+from ..engine import Node, Stop, get_rng, worker_id
+from ..augmentations.base import FusedPointwise, fuse_pointwise
+from ..utils import BufferPool, batch_length, concat_batches, split_batch
 
 try:
     import Queue
 except:
     import queue as Queue
 
+MERGE_MODES = ('interleave', 'concat', 'zip')
+
 
 class Noise(Node):
     """
     Generate uniform noise for testing purposes.
     """
 
-    def __init__(self, data_shape=(10, 10, 10), n_tensors=2, n_worker=1, force_constant=False, queue_size=10):
+    def __init__(self, data_shape=(10, 10, 10), n_tensors=2, n_worker=1, force_constant=False, queue_size=10,
+                 executor='process'):
         self.data_shape = data_shape
         self.n_tensors = n_tensors
         self.force_constant = force_constant
-        super(Noise, self).__init__(n_worker=n_worker, queue_size=queue_size)
+        self.pool = BufferPool()
+        super(Noise, self).__init__(n_worker=n_worker, queue_size=queue_size, executor=executor)
 
     def loop(self):
-        tensors = []
-        for _ in range(self.n_tensors):
-            if self.force_constant:
-                data = np.zeros(self.data_shape, dtype=np.float32)
-            else:
-                data = np.random.uniform(size=self.data_shape)
-            tensors.append(data[np.newaxis])
-        tensors = np.concatenate(tensors)
+        shape = (self.n_tensors,) + tuple(self.data_shape)
+        if self.force_constant:
+            tensors = self.pool.acquire(shape, np.float32)
+            tensors.fill(0)
+        else:
+            tensors = self.pool.acquire(shape, np.float64)
+            get_rng().random(out=tensors)
         self.enqueue({"images": tensors})
 
 
+class TransformTimings(object):
+    """
+    Wall time and bytes processed per transform of an Augmentations node, shared between all of its worker
+    processes. Like NodeStats, every worker writes into its own row. Histograms have logarithmic bins: four per
+    decade of seconds from 1us to 100s and one per power of two of bytes.
+    """
+    TIME_EDGES = np.logspace(-6, 2, 33)
+    BYTE_EDGES = 2. ** np.arange(1, 41)
+    FIELDS = ('calls', 'time', 'bytes')
+    CALLS, TIME, BYTES = range(len(FIELDS))
+
+    def __init__(self, names, n_rows):
+        self.names = list(names)
+        self.n_rows = n_rows
+        self.n_time_bins = len(self.TIME_EDGES) + 1
+        self.n_byte_bins = len(self.BYTE_EDGES) + 1
+        self.width = len(self.FIELDS) + self.n_time_bins + self.n_byte_bins
+        self.counters = multiprocessing.RawArray('d', n_rows * len(self.names) * self.width)
+
+    def rows(self):
+        return np.frombuffer(self.counters, dtype=np.float64).reshape(self.n_rows, len(self.names), self.width)
+
+    def record(self, row, idx, seconds, nbytes):
+        counters = self.rows()[row % self.n_rows, idx]
+        counters[self.CALLS] += 1
+        counters[self.TIME] += seconds
+        counters[self.BYTES] += nbytes
+        time_bin = np.searchsorted(self.TIME_EDGES, seconds)
+        byte_bin = np.searchsorted(self.BYTE_EDGES, nbytes)
+        counters[len(self.FIELDS) + time_bin] += 1
+        counters[len(self.FIELDS) + self.n_time_bins + byte_bin] += 1
+
+    @staticmethod
+    def quantile(histogram, edges, q):
+        """
+        Upper bin edge below which a fraction q of the recorded values lies.
+        """
+        total = histogram.sum()
+        if not total:
+            return 0.
+        idx = int(np.searchsorted(np.cumsum(histogram), q * total))
+        return float(edges[idx]) if idx < len(edges) else float('inf')
+
+    def snapshot(self):
+        """
+        One dict per transform, in chain order.
+        """
+        totals = self.rows().sum(axis=0)
+        snapshots = []
+        for name, counters in zip(self.names, totals):
+            offset = len(self.FIELDS)
+            time_histogram = counters[offset:offset + self.n_time_bins]
+            byte_histogram = counters[offset + self.n_time_bins:]
+            calls = int(counters[self.CALLS])
+            seconds = float(counters[self.TIME])
+            nbytes = float(counters[self.BYTES])
+            snapshots.append({
+                'transform': name,
+                'calls': calls,
+                'time': seconds,
+                'bytes': nbytes,
+                'mean_time': seconds / calls if calls else 0.,
+                'p50_time': self.quantile(time_histogram, self.TIME_EDGES, 0.5),
+                'p99_time': self.quantile(time_histogram, self.TIME_EDGES, 0.99),
+                'throughput': nbytes / seconds if seconds else 0.,
+                'time_histogram': time_histogram.astype(np.int64),
+                'bytes_histogram': byte_histogram.astype(np.int64),
+            })
+        return snapshots
+
+    def report(self):
+        """
+        Table of all transforms, the most expensive first.
+        """
+        snapshots = sorted(self.snapshot(), key=lambda s: s['time'], reverse=True)
+        total = sum(s['time'] for s in snapshots) or 1.
+        lines = ["%-40s %8s %10s %6s %10s %10s %10s" % (
+            'transform', 'calls', 'time [s]', 'share', 'mean [ms]', 'p99 [ms]', 'MB/s')]
+        for s in snapshots:
+            lines.append("%-40s %8d %10.3f %5.1f%% %10.3f %10.3f %10.1f" % (
+                s['transform'][:40], s['calls'], s['time'], 100. * s['time'] / total, 1e3 * s['mean_time'],
+                1e3 * s['p99_time'], s['throughput'] / 1e6))
+        return "\n".join(lines)
+
+
+def _nbytes(images):
+    if isinstance(images, np.ndarray):
+        return images.nbytes
+    return sum(getattr(image, 'nbytes', 0) for image in images)
+
+
+def _transform_name(transform):
+    if not isinstance(transform, FusedPointwise):
+        return transform.__class__.__name__
+    if not transform.transforms:
+        return "Cast(%s)" % np.dtype(transform.dtype).name
+    return "Fused(%s)" % "+".join(t.__class__.__name__ for t in transform.transforms)
+
+
 class Augmentations(Node):
     """
     Node that applies a certain set of transforms in sequence.
+    With ordered=True batches leave the node in the order they arrived even with several workers, e.g. for
+    deterministic evaluation pipelines. Its consumer must then run a single worker.
+    Consecutive pointwise transforms (e.g. RescaleImages, AdditiveNoise) run fused in a single pass over the batch
+    unless fuse=False. With a dtype, images leave the node converted to it. Geometric transforms keep the dtype of
+    the images, so keeping them uint8 up to this point (or up to a Cast or RescaleImages late in the chain) moves
+    4-8x fewer bytes through the queues than converting early.
+    With record_params=True, the random parameters drawn for each batch are attached to it as values['params'],
+    from which replay() reproduces the augmentation exactly.
+    With profile=True, the wall time and input size of every transform is recorded across all workers, see
+    transform_stats() and report(). Fused transforms are timed together, set fuse=False to time them one by one.
     """
 
-    def __init__(self, transforms=(), deterministic=False, n_worker=4, queue_size=128):
+    def __init__(self, transforms=(), deterministic=False, n_worker=4, queue_size=128, autoscale=None,
+                 executor='process', ordered=False, fuse=True, dtype=None, record_params=False, seed=None,
+                 profile=False):
         self.transforms = transforms
         self.deterministic = deterministic
+        self.fuse = fuse
+        self.dtype = dtype
+        self.record_params = record_params
+        self.timings = None
+        if profile:
+            self.timings = TransformTimings([_transform_name(t) for t in self.compile()],
+                                            autoscale[1] if autoscale else n_worker)
+        self.chain = None
 
         super(Augmentations, self).__init__(
-            n_worker=n_worker, queue_size=queue_size)
+            n_worker=n_worker, queue_size=queue_size, autoscale=autoscale, executor=executor, ordered=ordered,
+            seed=seed)
 
-    def loop(self):
-        values = self.input.dequeue()
-        if len(self.transforms) > 0:
-            for transform in self.transforms:
+    def setup(self):
+        self.chain = self.compile()
+
+    def compile(self):
+        if self.fuse:
+            return fuse_pointwise(self.transforms, self.dtype)
+        chain = list(self.transforms)
+        if self.dtype is not None:
+            chain.append(FusedPointwise([], self.dtype))
+        return chain
+
+    def augment(self, values, params=None):
+        if self.chain is None:
+            self.chain = self.compile()
+        rng = get_rng()
+        drawn = []
+        for idx, transform in enumerate(self.chain):
+            if self.deterministic:
+                p = None
+            elif params is not None:
+                p = params[idx]
+            else:
+                p = transform.sample(values, rng)
+            if self.timings is not None:
+                nbytes = _nbytes(values['images'])
+                s = timer()
+            if p is None:
+                # Also works for augmentations that do not take params
                 values = transform.apply(values, self.deterministic)
-        self.enqueue(values)
+            else:
+                values = transform.apply(values, self.deterministic, p)
+            if self.timings is not None:
+                self.timings.record(worker_id(), idx, timer() - s, nbytes)
+            drawn.append(p)
+        if self.record_params:
+            values['params'] = drawn
+        return values
+
+    def transform_stats(self):
+        """
+        Per-transform timings summed over all workers, see TransformTimings.snapshot(). Requires profile=True.
+        """
+        if self.timings is None:
+            raise ValueError("Create the node with profile=True to collect transform timings.")
+        return self.timings.snapshot()
+
+    def report(self):
+        """
+        Per-transform timings as a table sorted by total time. Requires profile=True.
+        """
+        if self.timings is None:
+            raise ValueError("Create the node with profile=True to collect transform timings.")
+        return self.timings.report()
+
+    def replay(self, values, params):
+        """
+        Apply the augmentations again with parameters recorded in values['params'] of an earlier batch. Use
+        augmentations.base.select_params() to pick the parameters of single samples.
+        """
+        return self.augment(values, params)
+
+    def loop(self):
+        if self.ordered:
+            seq, values = self.dequeue_sequenced()
+            self.enqueue_sequenced(seq, self.augment(values))
+        else:
+            values = self.input.dequeue()
+            self.enqueue(self.augment(values))
+
+
+class Coalesce(Node):
+    """
+    Concatenates small batches from the input node into batches of batch_size samples along axis 0.
+    Useful after sources with tiny batches (e.g. LevelDBSource with a small batch_size) to amortize the per-item
+    queue overhead in later stages. Samples that do not fit into a batch are carried over into the next one.
+    """
+
+    def __init__(self, batch_size, n_worker=1, queue_size=16, executor='process'):
+        self.batch_size = batch_size
+        super(Coalesce, self).__init__(n_worker=n_worker, queue_size=queue_size, executor=executor)
+
+    def setup(self):
+        self.carry = []
+        self.n_carry = 0
+
+    def loop(self):
+        batches, n_samples = self.carry, self.n_carry
+        # Items from the input may be views into shared memory slots that the next dequeue recycles
+        queues = [self.input.queue] if hasattr(self.input.queue, 'owns') else []
+        while n_samples < self.batch_size:
+            # Every batch holds at least one sample, so never ask for more than still needed
+            for values in self.input.dequeue_many(self.batch_size - n_samples):
+                batches.append(transports.detach(values, queues))
+                n_samples += batch_length(values)
+
+        batch, rest = split_batch(concat_batches(batches), self.batch_size)
+        self.carry = [rest]
+        self.n_carry = n_samples - self.batch_size
+        if not self.n_carry:
+            self.carry = []
+        self.enqueue(batch)
+
+
+class Merge(Node):
+    """
+    Combines the outputs of several nodes. Attach it to each input node, e.g. with Graph.add(merge, inputs=[a, b]).
+    Modes:
+    'interleave' forwards items from all inputs in turn as they become available, until all inputs have stopped.
+    'concat' takes one batch from every input and concatenates them along axis 0.
+    'zip' takes one batch from every input and merges their keys, later inputs overriding earlier ones.
+    """
+
+    def __init__(self, mode='interleave', n_worker=1, queue_size=16, executor='process', poll_interval=0.005):
+        if mode not in MERGE_MODES:
+            raise ValueError("Unknown merge mode '%s'. Use one of %s." % (mode, ", ".join(MERGE_MODES)))
+        self.mode = mode
+        self.poll_interval = poll_interval
+        super(Merge, self).__init__(n_worker=n_worker, queue_size=queue_size, executor=executor)
+
+    def setup(self):
+        self.next_input = 0
+        self.drained = set()
+
+    def loop(self):
+        if self.mode == 'interleave':
+            n_inputs = len(self.inputs)
+            if len(self.drained) == n_inputs:
+                raise Stop()
+            for _ in range(n_inputs):
+                idx = self.next_input
+                node = self.inputs[idx]
+                self.next_input = (self.next_input + 1) % n_inputs
+                if idx in self.drained:
+                    continue
+                try:
+                    values = node.dequeue(block=False)
+                except Stop:
+                    self.drained.add(idx)
+                    continue
+                except Queue.Empty:
+                    # Inputs that stopped and have nothing left are done
+                    if node.stop.is_set():
+                        self.drained.add(idx)
+                    continue
+                self.enqueue(values)
+                return
+            # Nothing available anywhere, back off for a moment
+            time.sleep(self.poll_interval)
+            return
+
+        batches = [node.dequeue() for node in self.inputs]
+        if self.mode == 'concat':
+            self.enqueue(concat_batches(batches))
+        else:
+            values = {}
+            for batch in batches:
+                values.update(batch)
+            self.enqueue(values)
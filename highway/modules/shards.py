@@ -0,0 +1,163 @@
+import json
+import os
+import numpy as np
+
+from ..engine import Node, Stop, get_rng, worker_id
+from ..utils import get_directory_filenames, get_class_file_map, decode_image, load_file, shuffled_stream, \
+    BufferPool
+from ..constants import IMAGE_FILETYPES
+
+# Position of every encoded image within the data file of its shard and its class index, -1 if unlabeled
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('label', '<i4')])
+META_FILE = "meta.json"
+
+
+def shard_files(shard_dir, name):
+    """
+    Data, index and key files of a shard.
+    """
+    base = os.path.join(shard_dir, name)
+    return base + ".bin", base + ".idx.npy", base + ".keys"
+
+
+def pack_shards(data_dir, out_dir, shard_bytes=256 * 1024 * 1024, labeled=None, shuffle=True, seed=None):
+    """
+    Pack the images of a directory into shards of about shard_bytes each that ShardReader reads.
+    Every shard is a file of concatenated encoded images, an index with the offset, length and label of every
+    image and a file with their names. A directory of class folders (as read by ClfImgReader) is packed with
+    labels, a flat directory (as read by ImgReader) without. labeled forces either.
+    shuffle: Pack the images in random order, so that sequential reads of a shard mix classes.
+    Returns the number of packed images.
+    """
+    if labeled is None:
+        labeled = any(os.path.isdir(os.path.join(data_dir, f)) for f in os.listdir(data_dir))
+    if labeled:
+        file_map, _, classes = get_class_file_map(data_dir, IMAGE_FILETYPES)
+        samples = [(filename, label) for label, cls in enumerate(classes) for filename in sorted(file_map[cls])]
+    else:
+        classes = []
+        samples = [(filename, -1) for filename in sorted(get_directory_filenames(data_dir, IMAGE_FILETYPES))]
+    if not samples:
+        raise ValueError("No images found in %s." % data_dir)
+    if shuffle:
+        samples = [samples[idx] for idx in np.random.default_rng(seed).permutation(len(samples))]
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    shards, counts = [], []
+    data = None
+    for filename, label in samples:
+        if data is None or data.tell() >= shard_bytes:
+            if data is not None:
+                write_shard_index(out_dir, shards[-1], index, keys)
+                data.close()
+            shards.append("shard-%05d" % len(shards))
+            counts.append(0)
+            data = open(shard_files(out_dir, shards[-1])[0], "wb")
+            index, keys = [], []
+        encoded = load_file(os.path.join(data_dir, filename))
+        index.append((data.tell(), len(encoded), label))
+        keys.append(filename)
+        data.write(encoded)
+        counts[-1] += 1
+    write_shard_index(out_dir, shards[-1], index, keys)
+    data.close()
+
+    with open(os.path.join(out_dir, META_FILE), "w") as meta:
+        json.dump({'classes': classes, 'shards': shards, 'counts': counts}, meta)
+    return len(samples)
+
+
+def write_shard_index(out_dir, shard, index, keys):
+    _, index_file, keys_file = shard_files(out_dir, shard)
+    np.save(index_file, np.array(index, dtype=INDEX_DTYPE))
+    with open(keys_file, "w") as f:
+        f.write("\n".join(keys))
+
+
+class ShardReader(Node):
+    """
+    Reads images packed by pack_shards(). Shards are memory mapped, so reading a sample costs no file operations.
+    With random=True, every sample is drawn at random from all shards. Otherwise shards are dealt to the workers
+    and read sequentially in random order, mixed through a buffer of shuffle_buffer images. Every image is then
+    read exactly once per epoch, and with once=True every worker stops after one epoch. Consumers receive Stop
+    once all workers did.
+    With a shape (rows, cols), images are fitted to it and the batch is a single array.
+    Labeled shards add one-hot 'labels' to every batch.
+    """
+
+    def __init__(self, shard_dir, batch_size=32, shape=None, random=True, once=False, shuffle_buffer=1024,
+                 n_worker=1, executor='process'):
+        self.shard_dir = shard_dir
+        self.batch_size = batch_size
+        self.shape = shape
+        self.random = random
+        self.once = once
+        self.shuffle_buffer = shuffle_buffer
+
+        with open(os.path.join(shard_dir, META_FILE)) as meta:
+            meta = json.load(meta)
+        self.classes = meta['classes']
+        self.n_classes = len(self.classes)
+        self.shards = meta['shards']
+        self.starts = np.concatenate([[0], np.cumsum(meta['counts'])]).astype(np.int64)
+        self.n_samples = int(self.starts[-1])
+        if not random and len(self.shards) < n_worker:
+            raise ValueError("Cannot deal %d shards to %d workers." % (len(self.shards), n_worker))
+
+        self.pool = BufferPool()
+        self.stream = None
+        super(ShardReader, self).__init__(n_worker=n_worker, executor=executor)
+
+    def setup(self):
+        self.data, self.index, self.keys = [], [], []
+        for shard in self.shards:
+            data_file, index_file, keys_file = shard_files(self.shard_dir, shard)
+            self.data.append(np.memmap(data_file, dtype=np.uint8, mode='r'))
+            self.index.append(np.load(index_file, mmap_mode='r'))
+            with open(keys_file) as f:
+                self.keys.append(f.read().split("\n"))
+
+    def locate(self, sample):
+        shard = int(np.searchsorted(self.starts, sample, side='right')) - 1
+        return shard, int(sample - self.starts[shard])
+
+    def load(self, sample):
+        shard, position = self.locate(sample)
+        offset, length, _ = self.index[shard][position]
+        return decode_image(self.data[shard][offset:offset + length].tobytes(), self.shape)
+
+    def sequential_samples(self):
+        if self.stream is None:
+            shards = [np.arange(self.starts[shard], self.starts[shard + 1])
+                      for shard in range(worker_id() % self.n_worker, len(self.shards), self.n_worker)]
+            self.stream = shuffled_stream(shards, self.load, self.shuffle_buffer, get_rng(), self.once)
+        for _ in range(self.batch_size):
+            try:
+                yield next(self.stream)
+            except StopIteration:
+                return
+
+    def random_samples(self):
+        for sample in get_rng().integers(self.n_samples, size=self.batch_size):
+            yield sample, self.load(sample)
+
+    def loop(self):
+        samples = self.random_samples() if self.random else self.sequential_samples()
+        images, keys, labels = [], [], []
+        for sample, image in samples:
+            shard, position = self.locate(sample)
+            images.append(image)
+            keys.append(self.keys[shard][position])
+            labels.append(self.index[shard][position]['label'])
+        if not images:
+            raise Stop()
+
+        if self.shape is not None:
+            images = np.stack(images)
+        batch = {'images': images, 'keys': np.array(keys)}
+        if self.n_classes:
+            batch['labels'] = self.pool.acquire((len(labels), self.n_classes), np.float32)
+            batch['labels'].fill(0)
+            batch['labels'][np.arange(len(labels)), labels] = 1.
+        self.enqueue(batch)
@@ -1,5 +1,5 @@
+import functools
 import numpy as np
-from scipy import ndimage
 
 def flip_x(image):
     return image[:,::-1]
@@ -8,29 +8,96 @@ def flip_y(image):
     return image[::-1]
 
 def pad(image, size, mode='constant'):
-    if len(image.shape) == 3:
-        return np.pad(image, (size[0], size[0]), (size[1], size[1]), (0,0), mode=mode)
-    else:
-        return np.pad(image, (size[0], size[0]), (size[1], size[1]), mode=mode)
+    widths = ((size[0], size[0]), (size[1], size[1])) + ((0, 0),) * (image.ndim - 2)
+    return np.pad(image, widths, mode=mode)
 
-def crop(image, center, size):
-    cy, cx = center
-    y, x = size
+def crop(image, corner, size):
+    cy, cx = corner
+    h, w = size
     return image[cy:cy+h, cx:cx+w]
 
-def add_noise(tensor, strength=0.2, mu=0, sigma=50):
-    noise = np.random.normal(self.mu, self.sigma, size=images.shape)
-    noisy = image + self.strength * noise
+def flip_x_batch(images, mask):
+    """
+    Flip the images selected by the boolean mask along the x axis, in place.
+    """
+    images[mask] = images[mask][:, :, ::-1]
+    return images
+
+def pad_batch(images, size, mode='constant'):
+    widths = ((0, 0), (size[0], size[0]), (size[1], size[1])) + ((0, 0),) * (images.ndim - 3)
+    return np.pad(images, widths, mode=mode)
+
+def crop_batch(images, ys, xs, size):
+    """
+    Crop a window of the given size at (ys[i], xs[i]) out of every image i with a single gather.
+    """
+    n, height, width = images.shape[:3]
+    h, w = size
+    # View of all windows of each image, indexed by their top left corner
+    windows = np.lib.stride_tricks.as_strided(
+        images,
+        shape=(n, height - h + 1, width - w + 1, h, w) + images.shape[3:],
+        strides=images.strides[:3] + images.strides[1:3] + images.strides[3:],
+        writeable=False)
+    return windows[np.arange(n), ys, xs]
+
+def add_noise(tensor, strength=0.2, mu=0, sigma=50, out=None):
+    noise = np.random.normal(mu, sigma, size=tensor.shape)
+    return np.add(tensor, strength * noise, out=out, casting='unsafe')
 
 def shift(image, translation, mode='constant'):
+    from scipy import ndimage
     y, x = translation
     return ndimage.interpolation.shift(image, (y, x), image.dtype, mode=mode)
 
 def rotate(image, angle, order=0, reshape=False):
+    from scipy import ndimage
     return ndimage.interpolation.rotate(image, angle, order=order, reshape=reshape)
 
-def clipped_zoom(img, zoom_factor, **kwargs):
-    img = img.astype(np.float32)
+def affine_matrix(shape, angle=0., scale=1., translation=(0., 0.)):
+    """
+    Matrix and offset that map output to input coordinates of an image of the given shape (rows, cols) that is
+    rotated by angle degrees and scaled by scale around its center, then translated by (y, x) pixels.
+    """
+    center = (np.array(shape[:2], dtype=np.float64) - 1) / 2.
+    theta = np.deg2rad(angle)
+    # Inverse of the forward rotation and scaling
+    matrix = np.array([[np.cos(theta), np.sin(theta)],
+                       [-np.sin(theta), np.cos(theta)]]) / scale
+    offset = center - matrix.dot(center + np.asarray(translation, dtype=np.float64))
+    return matrix, offset
+
+def affine(image, matrix, offset, order=1, mode='constant', cval=0., output=None):
+    """
+    Resample an image once with a 2x2 matrix and offset as returned by affine_matrix. Channels are kept apart and
+    the dtype of the image is preserved.
+    """
+    from scipy import ndimage
+    if image.ndim > 2:
+        full = np.eye(image.ndim)
+        full[:2, :2] = matrix
+        matrix = full
+        offset = np.concatenate([offset, np.zeros(image.ndim - 2)])
+    if output is None:
+        output = np.empty_like(image)
+    ndimage.affine_transform(image, matrix, offset, output=output, order=order, mode=mode, cval=cval)
+    return output
+
+def clipped_zoom(img, zoom_factor, position=None, **kwargs):
+    """
+    Zoom an image while keeping its size and dtype. Zoomed out images are placed and zoomed in images are cropped
+    at the given position, fractions (y, x) in [0, 1) of the free space. Defaults to a random position.
+    """
+    from scipy.ndimage import zoom as ndimage_zoom
+
+    def zoom(image, factors, **kwargs):
+        if image.dtype.kind in 'iu' and kwargs.get('order', 3) > 1:
+            # Higher order splines overshoot, clip before going back to integers
+            zoomed = ndimage_zoom(image, factors, np.float32, **kwargs)
+            info = np.iinfo(image.dtype)
+            return np.clip(np.rint(zoomed), info.min, info.max).astype(image.dtype)
+        return ndimage_zoom(image, factors, image.dtype, **kwargs)
+
     h, w = img.shape[:2]
 
     # width and height of the zoomed image
@@ -41,30 +108,32 @@ def clipped_zoom(img, zoom_factor, **kwargs):
     # dimension, so instead we create a tuple of zoom factors, one per array
     # dimension, with 1's for any trailing dimensions after the width and height.
     zoom_tuple = (zoom_factor,) * 2 + (1,) * (img.ndim - 2)
+    if position is None:
+        position = np.random.random(2)
     # zooming out
     if zoom_factor < 1:
         # bounding box of the clip region within the output array
         if h > zh and w > zw:
-            top = np.random.randint(h - zh)
-            left = np.random.randint(w - zw)
+            top = int(position[0] * (h - zh))
+            left = int(position[1] * (w - zw))
         else:
             top = 0
             left = 0
         # zero-padding
-        out = np.zeros_like(img, dtype=np.float32)
-        out[top:top + zh, left:left + zw] = zoom(img, zoom_tuple, np.float32, **kwargs)
+        out = np.zeros_like(img)
+        out[top:top + zh, left:left + zw] = zoom(img, zoom_tuple, **kwargs)
 
     # zooming in
     elif zoom_factor > 1:
         # bounding box of the clip region within the input array
         if zh > h and zw > w:
-            top = np.random.randint(zh - h)
-            left = np.random.randint(zw - w)
+            top = int(position[0] * (zh - h))
+            left = int(position[1] * (zw - w))
         else:
             top = 0
             left = 0
 
-        out = zoom(img, zoom_tuple, np.float32, **kwargs)
+        out = zoom(img, zoom_tuple, **kwargs)
         out = out[top:top + h, left:left + w]
 
     # if zoom_factor == 1, just return the input array
@@ -75,11 +144,115 @@ def clipped_zoom(img, zoom_factor, **kwargs):
 def image_histogram_equalization(image, number_bins=256):
     # from http://www.janeriksolem.net/2009/06/histogram-equalization-with-python-and.html
     # get image histogram
-    image_histogram, bins = np.histogram(image.flatten(), number_bins, normed=True)
+    image_histogram, bins = np.histogram(image.flatten(), number_bins, density=True)
     cdf = image_histogram.cumsum()  # cumulative distribution function
     cdf = 255 * cdf / cdf[-1]  # normalize
 
     # use linear interpolation of cdf to find new pixel values
     image_equalized = np.interp(image.flatten(), bins[:-1], cdf)
 
-    return image_equalized.reshape(image.shape)
+    if image.dtype.kind in 'iu':
+        image_equalized = np.rint(image_equalized)
+    return image_equalized.reshape(image.shape).astype(image.dtype)
+
+def equalization_luts(images):
+    """
+    256-entry lookup table per uint8 image in the batch that equalizes its histogram, built with a single bincount.
+    """
+    n = len(images)
+    flat = images.reshape(n, -1)
+    offsets = np.arange(n, dtype=np.intp)[:, np.newaxis] * 256
+    histograms = np.bincount((flat + offsets).ravel(), minlength=n * 256).reshape(n, 256)
+    cdf = histograms.cumsum(axis=1)
+    return np.round(255. * cdf / cdf[:, -1:]).astype(np.uint8)
+
+def equalize_histograms(images, out=None):
+    """
+    Histogram equalization of a batch of uint8 images through per-image lookup tables. The dtype is kept.
+    """
+    n = len(images)
+    luts = equalization_luts(images)
+    offsets = np.arange(n, dtype=np.intp)[:, np.newaxis] * 256
+    equalized = luts.ravel().take(images.reshape(n, -1) + offsets)
+    if out is None:
+        return equalized.reshape(images.shape)
+    out[...] = equalized.reshape(images.shape)
+    return out
+
+RESIZE_KERNELS = {
+    'nearest': (None, 0.5),
+    'bilinear': (lambda x: np.maximum(1. - np.abs(x), 0.), 1.),
+    'bicubic': (lambda x: _cubic(x, -0.5), 2.),
+    'cubic': (lambda x: _cubic(x, -0.5), 2.),
+    'lanczos': (lambda x: np.sinc(x) * np.sinc(x / 3.) * (np.abs(x) < 3.), 3.),
+}
+
+def _cubic(x, a):
+    x = np.abs(x)
+    return np.where(x < 1, ((a + 2) * x - (a + 3)) * x * x + 1,
+                    np.where(x < 2, ((a * x - 5 * a) * x + 8 * a) * x - 4 * a, 0.))
+
+@functools.lru_cache(maxsize=64)
+def resize_weights(in_size, out_size, interp='bilinear'):
+    """
+    Source indices and weights, both of shape (out_size, taps), for resampling an axis of in_size pixels to
+    out_size pixels. When shrinking, kernels are widened by the scale factor to average over all covered pixels.
+    Results for the most recent sizes are cached, so they must not be modified.
+    """
+    if interp not in RESIZE_KERNELS:
+        raise ValueError("Unknown interpolation '%s'. Use one of %s." % (interp, ", ".join(sorted(RESIZE_KERNELS))))
+
+    kernel, support = RESIZE_KERNELS[interp]
+    scale = float(in_size) / out_size
+    centers = (np.arange(out_size) + 0.5) * scale
+    if kernel is None:
+        indices = np.minimum(centers.astype(np.intp), in_size - 1)[:, np.newaxis]
+        weights = np.ones((out_size, 1), dtype=np.float32)
+    else:
+        filter_scale = max(scale, 1.)
+        support = support * filter_scale
+        taps = int(np.ceil(support)) * 2 + 1
+        indices = np.floor(centers - support + 0.5).astype(np.intp)[:, np.newaxis] + np.arange(taps)
+        weights = kernel((indices + 0.5 - centers[:, np.newaxis]) / filter_scale)
+        weights[(indices < 0) | (indices >= in_size)] = 0.
+        weights /= weights.sum(axis=1, keepdims=True)
+        # Taps that are zero for every output pixel
+        used = np.any(weights != 0, axis=0)
+        indices, weights = indices[:, used], weights[:, used]
+        indices = np.clip(indices, 0, in_size - 1)
+        weights = weights.astype(np.float32)
+    indices.flags.writeable = False
+    weights.flags.writeable = False
+    return indices, weights
+
+def _resample_axis(images, axis, indices, weights):
+    shape = [1] * images.ndim
+    shape[axis] = -1
+    result = None
+    for tap in range(indices.shape[1]):
+        term = np.take(images, indices[:, tap], axis=axis)
+        if weights.shape[1] > 1:
+            # Promotes integer images to float32
+            term = np.multiply(term, weights[:, tap].reshape(shape), dtype=np.float32)
+        result = term if result is None else np.add(result, term, out=result)
+    return result
+
+def resize_batch(images, size, interp='bilinear', out=None):
+    """
+    Resize a batch of same-sized images (N, H, W[, C]) to size (rows, cols) with separable, cached tap weights.
+    The dtype is kept, integers are rounded and clipped.
+    """
+    rows, cols = size
+    row_indices, row_weights = resize_weights(images.shape[1], rows, interp)
+    col_indices, col_weights = resize_weights(images.shape[2], cols, interp)
+    dtype = images.dtype
+    resized = _resample_axis(images, 1, row_indices, row_weights)
+    resized = _resample_axis(resized, 2, col_indices, col_weights)
+    if out is None:
+        out = np.empty((images.shape[0], rows, cols) + images.shape[3:], dtype=dtype)
+    if out.dtype.kind in 'iu' and resized.dtype.kind == 'f':
+        info = np.iinfo(out.dtype)
+        np.rint(resized, out=resized)
+        np.clip(resized, info.min, info.max, out=resized)
+    out[...] = resized
+    return out
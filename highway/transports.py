@@ -0,0 +1,197 @@
+import collections
+import multiprocessing
+import threading
+import numpy as np
+
+try:
+    import Queue
+except:
+    import queue as Queue
+
+ALIGNMENT = 64
+
+# Placeholder for an array that lives in a shared memory slot
+SlotArray = collections.namedtuple('SlotArray', ['offset', 'dtype', 'shape'])
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _is_packable(value):
+    return isinstance(value, np.ndarray) and not value.dtype.hasobject
+
+
+def _is_sequence(obj):
+    return isinstance(obj, (list, tuple))
+
+
+def _rebuild(obj, items):
+    if hasattr(obj, '_fields'):
+        # namedtuple
+        return type(obj)(*items)
+    return type(obj)(items)
+
+
+def _payload_bytes(obj):
+    if _is_packable(obj):
+        return _aligned(obj.nbytes)
+    if isinstance(obj, dict):
+        return sum(_payload_bytes(v) for v in obj.values())
+    if _is_sequence(obj):
+        return sum(_payload_bytes(v) for v in obj)
+    return 0
+
+
+def detach(obj, queues=None):
+    """
+    Copy all arrays in obj that are views into slots of the given shared memory queues, so that obj stays valid
+    once the slots are released. Without queues, all arrays are copied.
+    """
+    if isinstance(obj, np.ndarray):
+        if queues is None or any(q.owns(obj) for q in queues):
+            return obj.copy()
+        return obj
+    if isinstance(obj, dict):
+        return dict((k, detach(v, queues)) for k, v in obj.items())
+    if _is_sequence(obj):
+        return _rebuild(obj, [detach(v, queues) for v in obj])
+    return obj
+
+
+class SharedMemoryQueue(object):
+    """
+    Queue that moves numpy arrays through a ring of preallocated shared memory slots instead of pickling them
+    through a pipe. Only a small header describing the arrays of an item travels through the underlying queues.
+    Arrays nested in dicts, lists or tuples are written once into a free slot, everything else is pickled as usual.
+    Items that do not fit into a slot fall back to plain pickling.
+
+    By default, consumers get views into the slot. The slot stays leased to the consumer thread until it calls
+    release(), which nodes do before fetching their next item. Arrays must therefore not be used after the next
+    dequeue. Node.enqueue() copies views that are passed on to queues which serialize items asynchronously (e.g.
+    the feeder thread of a multiprocessing queue), see detach(). Set copy=True to receive copies and release slots
+    immediately.
+
+    Pass an instance as queue_size to any Node to use it as the node's output queue:
+        Noise(queue_size=SharedMemoryQueue(maxsize=8, slot_size=32 * 320 * 240 * 3 * 8))
+    """
+
+    def __init__(self, maxsize=8, slot_size=64 * 1024 * 1024, copy=False):
+        if maxsize < 1:
+            raise ValueError("SharedMemoryQueue needs at least one slot.")
+        self.maxsize = maxsize
+        self.slot_size = _aligned(slot_size)
+        self.copy = copy
+
+        self.buffer = multiprocessing.RawArray('b', self.maxsize * self.slot_size)
+        self.ready = multiprocessing.Queue(maxsize=maxsize)
+        self.free = multiprocessing.Queue(maxsize=maxsize)
+        for slot in range(maxsize):
+            self.free.put(slot)
+
+        self._view = None
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view'] = None
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def clone(self):
+        """
+        Create an empty queue with the same configuration.
+        """
+        return SharedMemoryQueue(self.maxsize, self.slot_size, self.copy)
+
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = np.frombuffer(self.buffer, dtype=np.uint8)
+        return self._view
+
+    def owns(self, arr):
+        """
+        Whether arr may point into one of the slots of this queue.
+        """
+        return not self.copy and np.may_share_memory(arr, self.view)
+
+    def put(self, obj, block=True, timeout=None):
+        if _payload_bytes(obj) > self.slot_size:
+            self.ready.put((-1, obj), block, timeout)
+            return
+
+        try:
+            slot = self.free.get(block, timeout)
+        except Queue.Empty:
+            raise Queue.Full()
+
+        header = self._pack(obj, [slot * self.slot_size])
+        try:
+            self.ready.put((slot, header), block, timeout)
+        except Queue.Full:
+            self.free.put(slot)
+            raise
+
+    def get(self, block=True, timeout=None):
+        slot, header = self.ready.get(block, timeout)
+        if slot < 0:
+            return header
+
+        obj = self._unpack(header)
+        if self.copy:
+            self.free.put(slot)
+        else:
+            self.leases.append(slot)
+        return obj
+
+    @property
+    def leases(self):
+        if not hasattr(self._local, 'slots'):
+            self._local.slots = []
+        return self._local.slots
+
+    def release(self):
+        """
+        Hand all slots leased by the calling thread back to the producers.
+        """
+        leases = self.leases
+        while leases:
+            self.free.put(leases.pop())
+
+    def _pack(self, obj, cursor):
+        if _is_packable(obj):
+            offset = cursor[0]
+            target = self.view[offset:offset + obj.nbytes].view(obj.dtype).reshape(obj.shape)
+            target[...] = obj
+            cursor[0] += _aligned(obj.nbytes)
+            return SlotArray(offset, obj.dtype, obj.shape)
+        if isinstance(obj, dict):
+            return dict((k, self._pack(v, cursor)) for k, v in obj.items())
+        if _is_sequence(obj):
+            return _rebuild(obj, [self._pack(v, cursor) for v in obj])
+        return obj
+
+    def _unpack(self, header):
+        if type(header) is SlotArray:
+            nbytes = header.dtype.itemsize * int(np.prod(header.shape))
+            arr = self.view[header.offset:header.offset + nbytes].view(header.dtype).reshape(header.shape)
+            return arr.copy() if self.copy else arr
+        if isinstance(header, dict):
+            return dict((k, self._unpack(v)) for k, v in header.items())
+        if _is_sequence(header):
+            return _rebuild(header, [self._unpack(v) for v in header])
+        return header
+
+    def qsize(self):
+        return self.ready.qsize()
+
+    def empty(self):
+        return self.ready.empty()
+
+    def full(self):
+        return self.ready.full()
@@ -1,30 +1,82 @@
-from PIL import Image, ImageOps
-from scipy.ndimage.interpolation import zoom
+import io
+import mmap
+import multiprocessing
 import numpy as np
 import os
 import sys
+import threading
 from collections import OrderedDict
 
+from .engine import worker_id
+
 
 def get_ext(filename):
     name, ext = os.path.splitext(filename)
     return ext
 
 
-def load_image(filename):
+def open_reduced(filename, shape=None):
+    """
+    Open an image, decoding it at reduced resolution if it is much larger than shape (rows, cols) would need for
+    fitting. JPEGs are scaled down in the DCT domain while decoding (draft mode), other formats are reduced by an
+    integer factor by binning where their mode allows it. The result is still at least as large as needed to fit shape.
+    """
+    from PIL import Image
     img = Image.open(filename)
+    if shape is None:
+        return img
+    width, height = img.size
+    # Fitting crops to the aspect ratio of shape, so only the side with the smaller ratio limits the reduction
+    scale = max(float(shape[1]) / width, float(shape[0]) / height)
+    if scale >= 1:
+        return img
+    needed = (int(np.ceil(width * scale)), int(np.ceil(height * scale)))
+    if img.format == 'JPEG':
+        img.draft(img.mode, needed)
+    factor = min(img.size[0] // needed[0], img.size[1] // needed[1])
+    # Palette indices cannot be binned and Pillow cannot reduce bilevel or 16 bit images, so these are decoded in full
+    reducible = img.mode not in ('1', 'P', 'PA') and not img.mode.startswith('I;')
+    if factor > 1 and reducible and hasattr(img, 'reduce'):
+        img = img.reduce(factor)
+    return img
+
+
+def load_image(filename, shape=None, method=None):
+    """
+    Load an image as array. With a shape (rows, cols), the image is decoded at reduced resolution and fitted to it.
+    """
+    if shape is not None:
+        return load_and_fit_image(filename, shape, method)
+    img = open_reduced(filename)
     return np.array(img)
 
 
-def load_and_fit_image(filename, shape, method=Image.NEAREST):
-    img = Image.open(filename)
+def load_and_fit_image(filename, shape, method=None):
+    from PIL import Image, ImageOps
+    if method is None:
+        method = Image.NEAREST
+    img = open_reduced(filename, shape)
     fitted = ImageOps.fit(img, shape[::-1], method=method)
     return np.array(fitted)
 
 
+def save_image(filename, image):
+    from PIL import Image
+    if image.dtype != np.uint8:
+        image = np.clip(image, 0, 255).astype(np.uint8)
+    Image.fromarray(image.squeeze()).save(filename)
+
+
 def load_file(filename):
-    file = open(filename, "rb").read()
-    return file
+    with open(filename, "rb") as file:
+        return file.read()
+
+
+def decode_image(data, shape=None, method=None):
+    """
+    Decode the contents of an image file like load_image() does.
+    """
+    return load_image(io.BytesIO(data), shape, method)
 
 
 def load_file_chunked(filename, chunk_size=1024):
@@ -59,6 +111,85 @@ def get_class_file_map(data_dir, extensions=False):
     return file_map, n_classes, classes
 
 
+def batch_length(batch):
+    """
+    Number of samples in a batch dict, taken from its first array or list.
+    """
+    for value in batch.values():
+        if isinstance(value, (np.ndarray, list, tuple)):
+            return len(value)
+    return 0
+
+
+def concat_batches(batches):
+    """
+    Concatenate batch dicts along axis 0. Arrays are concatenated, lists joined and other values taken from the
+    first batch.
+    """
+    if len(batches) == 1:
+        return batches[0]
+    result = {}
+    for key, value in batches[0].items():
+        if isinstance(value, np.ndarray):
+            result[key] = np.concatenate([batch[key] for batch in batches])
+        elif isinstance(value, (list, tuple)):
+            result[key] = [item for batch in batches for item in batch[key]]
+        else:
+            result[key] = value
+    return result
+
+
+def split_batch(batch, n):
+    """
+    Split a batch dict into its first n samples and the rest.
+    """
+    head, tail = {}, {}
+    for key, value in batch.items():
+        if isinstance(value, (np.ndarray, list, tuple)):
+            head[key], tail[key] = value[:n], value[n:]
+        else:
+            head[key] = tail[key] = value
+    return head, tail
+
+
+class BufferPool(object):
+    """
+    Recycles preallocated batch arrays so that stages can fill their output in place instead of concatenating a
+    fresh batch on every loop. An array handed out by acquire() goes back to the pool once nobody references it
+    anymore, i.e. consumers release a batch by dropping it. Queues that copy on put (SharedMemoryQueue, or the
+    pickling feeder thread of a multiprocessing queue once it has sent the item) release it by themselves.
+    At most max_buffers arrays are kept per shape and dtype.
+    """
+
+    def __init__(self, max_buffers=4):
+        self.max_buffers = max_buffers
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'max_buffers': self.max_buffers}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_buffers'])
+
+    def acquire(self, shape, dtype=np.float32):
+        """
+        An uninitialized array of the given shape and dtype that nobody else uses.
+        """
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        with self.lock:
+            buffers = self.buffers.setdefault((shape, dtype.str), [])
+            for idx in range(len(buffers)):
+                # Only referenced by the pool and the argument of getrefcount
+                if sys.getrefcount(buffers[idx]) == 2:
+                    return buffers[idx]
+            buffer = np.empty(shape, dtype)
+            if len(buffers) < self.max_buffers:
+                buffers.append(buffer)
+            return buffer
+
+
 class LimitedSizeDict(OrderedDict):
 
     def __init__(self, *args, **kwds):
@@ -79,17 +210,276 @@ class LimitedSizeDict(OrderedDict):
 class FIFOCache(object):
     """
     Pretty stupid cache that pops the first item once full. No strategy here as
-    we usually don't want biased statistics anyway.
+    we usually don't want biased statistics anyway. Thread workers of a node share it, hence the lock.
     """
     def __init__(self, size_limit=10000):
         self.size_limit = size_limit
         self.store = LimitedSizeDict(size_limit=size_limit)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'size_limit': self.size_limit}
+
+    def __setstate__(self, state):
+        self.__init__(state['size_limit'])
 
     def get(self, key):
-        if key not in self.store:
-            return None
-        else:
+        with self.lock:
+            return self.store.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.store[key] = value
+
+
+def nbytes(value):
+    """
+    Memory taken by an array, or the length of a bytes object.
+    """
+    return value.nbytes if hasattr(value, 'nbytes') else len(value)
+
+
+class ByteBudgetCache(object):
+    """
+    Cache bounded by the total size of its values (see nbytes()) rather than their number.
+    policy selects which value is evicted once the budget is exceeded:
+    'lru' the least recently used one, 'clock' the next one without a recent hit in a ring of all values
+    (an approximation of LRU with cheaper hits), 'random' a random one.
+    admit: Optional function admit(key, value) that decides whether a value is cached at all.
+    Values larger than the budget are never cached.
+    Every process holds its own values. The hit, miss, eviction and rejection counters are shared though, with a
+    row for each of n_rows workers, so that stats() of a cache created before forking covers all workers.
+    """
+    POLICIES = ('lru', 'clock', 'random')
+    COUNTERS = ('hits', 'misses', 'evictions', 'rejections')
+
+    def __init__(self, max_bytes=1 << 30, policy='lru', admit=None, seed=None, n_rows=1):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown eviction policy '%s'. Use one of %s." % (policy, ", ".join(self.POLICIES)))
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.admit = admit
+        self.seed = seed
+        self.n_rows = n_rows
+        self.counters = multiprocessing.RawArray('q', n_rows * len(self.COUNTERS))
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.store = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        # Ring of keys with a reference bit each for 'clock', list of keys for 'random'
+        self.ring = []
+        self.positions = {}
+        self.referenced = {}
+        self.free = []
+        self.hand = 0
+        self.rng = np.random.default_rng(self.seed)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def count(self, counter):
+        row = worker_id() % self.n_rows
+        self.counters[row * len(self.COUNTERS) + self.COUNTERS.index(counter)] += 1
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.store:
+                self.count('misses')
+                return None
+            self.count('hits')
+            if self.policy == 'lru':
+                self.store[key] = self.store.pop(key)
+            elif self.policy == 'clock':
+                self.referenced[key] = True
             return self.store[key]
 
     def set(self, key, value):
-        self.store[key] = value
+        size = nbytes(value)
+        with self.lock:
+            if key in self.store:
+                self._remove(key)
+            if size > self.max_bytes or (self.admit is not None and not self.admit(key, value)):
+                self.count('rejections')
+                return
+            while self.bytes + size > self.max_bytes:
+                self._remove(self._victim())
+                self.count('evictions')
+            self.store[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+            if self.policy != 'lru':
+                position = self.free.pop() if self.free else len(self.ring)
+                if position == len(self.ring):
+                    self.ring.append(key)
+                else:
+                    self.ring[position] = key
+                self.positions[key] = position
+                self.referenced[key] = False
+
+    def _victim(self):
+        if self.policy == 'lru':
+            return next(iter(self.store))
+        if self.policy == 'random':
+            while True:
+                key = self.ring[self.rng.integers(len(self.ring))]
+                if key is not None:
+                    return key
+        while True:
+            key = self.ring[self.hand]
+            self.hand = (self.hand + 1) % len(self.ring)
+            if key is None:
+                continue
+            if not self.referenced[key]:
+                return key
+            self.referenced[key] = False
+
+    def _remove(self, key):
+        del self.store[key]
+        self.bytes -= self.sizes.pop(key)
+        if self.policy != 'lru':
+            position = self.positions.pop(key)
+            del self.referenced[key]
+            self.ring[position] = None
+            self.free.append(position)
+
+    def stats(self):
+        """
+        Counters summed over all workers, items and bytes held by the calling process.
+        """
+        totals = np.frombuffer(self.counters, np.int64).reshape(self.n_rows, -1).sum(0)
+        stats = dict((counter, int(total)) for counter, total in zip(self.COUNTERS, totals))
+        lookups = stats['hits'] + stats['misses']
+        stats.update({'items': len(self.store), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                      'hit_rate': float(stats['hits']) / lookups if lookups else 0.})
+        return stats
+
+
+class EncodedImageCache(object):
+    """
+    Image cache that keeps the encoded file contents within a ByteBudgetCache of max_bytes and decodes them on
+    every hit. Encoded images take a fraction of the memory of decoded ones, so many more fit into the budget.
+    decoded_bytes: Budget of an optional second cache of decoded images that is consulted first.
+    Images are decoded like load_image() with the given shape.
+    """
+
+    def __init__(self, max_bytes=1 << 30, shape=None, policy='lru', decoded_bytes=None, n_rows=1):
+        self.shape = shape
+        self.encoded = ByteBudgetCache(max_bytes, policy, n_rows=n_rows)
+        self.decoded = None
+        if decoded_bytes is not None:
+            self.decoded = ByteBudgetCache(decoded_bytes, policy, n_rows=n_rows)
+
+    def load(self, key, filename):
+        """
+        The decoded image of filename, which is only read if key is not cached.
+        """
+        if self.decoded is not None:
+            image = self.decoded.get(key)
+            if image is not None:
+                return image
+        data = self.encoded.get(key)
+        if data is None:
+            data = load_file(filename)
+            self.encoded.set(key, data)
+        image = decode_image(data, self.shape)
+        if self.decoded is not None:
+            self.decoded.set(key, image)
+        return image
+
+    def stats(self):
+        stats = {'encoded': self.encoded.stats()}
+        if self.decoded is not None:
+            stats['decoded'] = self.decoded.stats()
+        return stats
+
+
+class SharedArrayCache(object):
+    """
+    Cache for arrays that all worker processes of a node share. Keys are integers in range(n_keys).
+    Arrays live in an anonymous memory map of capacity slots of slot_size bytes each, which is only committed
+    as slots are filled. Arrays that do not fit into a slot are not cached. Once full, slots are reused in
+    round robin order. The cache must be created before the workers are forked; get() returns copies.
+    """
+    MAX_DIMS = 4
+
+    def __init__(self, n_keys, capacity, slot_size):
+        self.n_keys = n_keys
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.arena = mmap.mmap(-1, max(1, capacity * slot_size))
+        # Slot + 1 of every key, 0 if not cached
+        self.index = multiprocessing.RawArray('l', n_keys)
+        # Key + 1, dtype char, ndim and shape of the array in every slot
+        self.meta = multiprocessing.RawArray('q', capacity * (self.MAX_DIMS + 3))
+        self.hand = multiprocessing.RawValue('l', 0)
+        self.lock = multiprocessing.Lock()
+
+    def _slot(self, slot):
+        meta = np.frombuffer(self.meta, np.int64).reshape(self.capacity, -1)[slot]
+        data = np.frombuffer(self.arena, np.uint8, self.slot_size, slot * self.slot_size)
+        return meta, data
+
+    def get(self, key):
+        with self.lock:
+            slot = self.index[key] - 1
+            if slot < 0:
+                return None
+            meta, data = self._slot(slot)
+            dtype = np.dtype(chr(meta[1]))
+            shape = tuple(meta[3:3 + meta[2]])
+            return data[:dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape).copy()
+
+    def set(self, key, value):
+        if value.nbytes > self.slot_size or value.ndim > self.MAX_DIMS or value.dtype.hasobject:
+            return
+        with self.lock:
+            if self.index[key] or self.capacity == 0:
+                return
+            slot = self.hand.value
+            self.hand.value = (slot + 1) % self.capacity
+            meta, data = self._slot(slot)
+            if meta[0]:
+                self.index[meta[0] - 1] = 0
+            meta[:3] = key + 1, ord(value.dtype.char), value.ndim
+            meta[3:3 + value.ndim] = value.shape
+            data[:value.nbytes] = np.ascontiguousarray(value).reshape(-1).view(np.uint8)
+            self.index[key] = slot + 1
+
+
+def shard_indices(n_items, shard_size, worker=0, n_workers=1):
+    """
+    Split range(n_items) into contiguous shards of shard_size items and return the ones of the given worker.
+    Shards are dealt to the workers in turn, so the shards of all workers cover every item exactly once.
+    """
+    starts = range(worker * shard_size, n_items, n_workers * shard_size)
+    return [np.arange(start, min(start + shard_size, n_items)) for start in starts]
+
+
+def shuffled_stream(shards, load, buffer_size, rng, once=False):
+    """
+    Yield (index, load(index)) for all indices in shards, epoch after epoch.
+    Every epoch visits the shards in random order and loads the indices of a shard sequentially. Loaded items
+    are mixed through a buffer of at most buffer_size items, which is drained at the end of the epoch, so every
+    index is yielded exactly once per epoch.
+    """
+    while True:
+        buffer = []
+        for shard in rng.permutation(len(shards)):
+            for idx in shards[shard]:
+                item = (idx, load(idx))
+                if len(buffer) < buffer_size:
+                    buffer.append(item)
+                    continue
+                slot = rng.integers(buffer_size)
+                yield buffer[slot]
+                buffer[slot] = item
+        for slot in rng.permutation(len(buffer)):
+            yield buffer[slot]
+        if once:
+            return
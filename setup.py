@@ -56,12 +56,13 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
 
     # What does your project relate to?
@@ -71,6 +72,9 @@ setup(
     # simple. Or you can use find_packages().
     packages=find_packages(exclude=['tests', 'benchmarks']),
 
+    # Worker random generators and the asyncio API need these versions
+    python_requires='>=3.7',
+
     # Alternatively, if you want to distribute just a my_module.py, uncomment
     # this:
     #   py_modules=["my_module"],
@@ -79,7 +83,7 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['numpy', 'Pillow', 'scipy', 'pyzmq', 'msgpack-python', 'msgpack_numpy', 'plyvel'],
+    install_requires=['numpy>=1.17', 'Pillow', 'scipy', 'pyzmq', 'msgpack-python', 'msgpack_numpy', 'plyvel'],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
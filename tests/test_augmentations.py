@@ -1,6 +1,11 @@
 import numpy as np
+from PIL import Image
 
-from highway.augmentations.img import FlipX, Resize, TopCenterCrop
+from highway.augmentations.img import AdditiveNoise, Cast, FlipX, HistEq, PadCrop, RandomAffine, RescaleImages, \
+    Resize, Slicer, TopCenterCrop, Zoom
+from highway.augmentations.base import FusedPointwise, fuse_pointwise, select_params
+from highway.modules.processing import Augmentations
+from highway.transforms.img import affine, affine_matrix, clipped_zoom, image_histogram_equalization, resize_weights
 
 
 class TestAugmentations:
@@ -36,3 +41,152 @@ class TestAugmentations:
         r = TopCenterCrop((20, 20)).apply({"images": [arr]})
         for image in r['images']:
             assert image.shape == (20, 20)
+
+    def test_flip_x_batch(self):
+        np.random.seed(0)
+        arr = np.random.uniform(size=(64, 4, 5, 3))
+        r = FlipX().apply({"images": arr.copy()})
+        flipped = [(image == original[:, ::-1]).all() for image, original in zip(r["images"], arr)]
+        kept = [(image == original).all() for image, original in zip(r["images"], arr)]
+        assert all(f or k for f, k in zip(flipped, kept))
+        assert 0 < sum(flipped) < 64
+
+    def test_pad_crop(self):
+        arr = np.random.uniform(size=(16, 8, 10, 3))
+        r = PadCrop(padsize=2).apply({"images": arr.copy()})
+        assert r["images"].shape == arr.shape
+        for image, original in zip(r["images"], arr):
+            # Every output is a shifted window of the zero-padded input
+            padded = np.pad(original, ((2, 2), (2, 2), (0, 0)), mode='constant')
+            assert any((padded[y:y + 8, x:x + 10] == image).all() for y in range(5) for x in range(5))
+
+    def test_topcenter_crop_batch(self):
+        arr = np.random.uniform(size=(4, 30, 40, 3))
+        r = TopCenterCrop((20, 20)).apply({"images": arr})
+        assert r["images"].shape == (4, 20, 20, 3)
+        assert (r["images"] == arr[:, :20, 10:30]).all()
+
+    def test_random_affine(self):
+        arr = (np.random.uniform(size=(4, 12, 16, 3)) * 255).astype(np.uint8)
+
+        r = RandomAffine().apply({"images": arr.copy()})
+        assert r["images"].dtype == np.uint8
+        assert (r["images"] == arr).all()
+
+        r = RandomAffine(shift=0.2, angle=30, zoom=0.2).apply({"images": arr.copy()})
+        assert r["images"].shape == arr.shape and r["images"].dtype == np.uint8
+        assert not (r["images"] == arr).all()
+
+    def test_affine_shift(self):
+        image = np.random.uniform(size=(10, 10))
+        matrix, offset = affine_matrix(image.shape, translation=(2, 3))
+        shifted = affine(image, matrix, offset, order=0)
+        assert (shifted[2:, 3:] == image[:-2, :-3]).all()
+        assert (shifted[:2] == 0).all()
+
+    def test_fused_pointwise(self):
+        arr = (np.random.uniform(size=(64, 8, 8, 3)) * 255).astype(np.uint8)
+        chain = fuse_pointwise([FlipX(), RescaleImages(), AdditiveNoise(), RescaleImages(2., 0.)])
+        assert len(chain) == 2 and isinstance(chain[1], FusedPointwise)
+
+        fused = FusedPointwise([RescaleImages(), RescaleImages(2., 1.)], chunk_bytes=1000)
+        r = fused.apply({"images": arr.copy()}, deterministic=True)
+        assert r["images"].dtype == np.float32
+        assert np.allclose(r["images"], ((arr.astype(np.float32) - 128.) / 128. - 1.) * 2.)
+
+        cast = FusedPointwise([RescaleImages(1., 0.)], dtype=np.uint8)
+        r = cast.apply({"images": arr.copy()}, deterministic=True)
+        assert r["images"].dtype == np.uint8 and (r["images"] == arr).all()
+
+    def test_fused_pointwise_in_place(self):
+        arr = np.random.uniform(size=(8, 4, 4)).astype(np.float32)
+        expected = (arr - 128.) / 128.
+        r = RescaleImages().apply({"images": arr}, deterministic=True)
+        assert r["images"] is arr
+        assert np.allclose(arr, expected)
+
+    def test_histeq_uint8(self):
+        arr = (np.random.beta(2, 5, size=(8, 16, 16, 3)) * 255).astype(np.uint8)
+        expected = np.stack([image_histogram_equalization(image) for image in arr]).astype(np.float64)
+        r = HistEq().apply({"images": arr.copy()})
+        assert r["images"].dtype == np.uint8
+        # Same mapping up to the binning of the float implementation
+        assert np.abs(r["images"] - expected).mean() < 1.
+        assert r["images"].max() == 255
+
+    def test_histeq_fused_keeps_uint8(self, monkeypatch):
+        import highway.augmentations.img as img
+        calls = []
+        equalize = img.equalize_histograms
+        monkeypatch.setattr(img, "equalize_histograms",
+                            lambda *args, **kwargs: calls.append(1) or equalize(*args, **kwargs))
+        arr = (np.random.beta(2, 5, size=(8, 16, 16, 3)) * 255).astype(np.uint8)
+        unfused = RescaleImages().apply(HistEq().apply({"images": arr.copy()}))["images"]
+        fused = FusedPointwise([HistEq(), RescaleImages()], chunk_bytes=2000).apply({"images": arr.copy()})["images"]
+        assert fused.dtype == np.float32
+        assert (fused == unfused).all()
+        assert len(calls) > 1
+
+    def test_slicer(self):
+        arr = np.random.uniform(size=(16, 30, 40, 3))
+        r = Slicer(height=0.5, width=0.5).apply({"images": arr}, deterministic=True)
+        assert np.may_share_memory(r["images"], arr)
+        assert (r["images"] == arr[:, 7:22, 10:30]).all()
+
+        r = Slicer(height=0.5, width=0.5).apply({"images": arr})
+        assert r["images"].shape == (16, 15, 20, 3)
+        for image, original in zip(r["images"], arr):
+            assert any((original[y:y + 15, x:x + 20] == image).all() for y in range(16) for x in range(21))
+
+    def test_replay(self):
+        arr = np.random.uniform(size=(8, 10, 12, 3)).astype(np.float32)
+        node = Augmentations([FlipX(), PadCrop(2), RandomAffine(0.1, 10, 0.1), AdditiveNoise(sigma=5)],
+                             record_params=True)
+        r = node.augment({"images": arr.copy()})
+        assert len(r["params"]) == 4
+
+        # Replay the augmentation of a single sample
+        replayed = node.replay({"images": arr[3:4].copy()}, select_params(r["params"], slice(3, 4)))
+        assert np.allclose(replayed["images"][0], r["images"][3])
+
+    def test_dtypes_are_preserved(self):
+        arr = (np.random.uniform(size=(4, 20, 20, 3)) * 255).astype(np.uint8)
+        assert clipped_zoom(arr[0], 1.3, order=1).dtype == np.uint8
+        assert clipped_zoom(arr[0], 0.7, order=3).dtype == np.uint8
+        assert Zoom(0.2).apply({"images": arr.copy()})["images"].dtype == np.uint8
+        assert image_histogram_equalization(arr[0].astype(np.float32)).dtype == np.float32
+        assert RescaleImages().apply({"images": arr.astype(np.float64)})["images"].dtype == np.float32
+
+    def test_cast(self):
+        arr = (np.random.uniform(size=(4, 6, 6, 3)) * 255).astype(np.uint8)
+        chain = fuse_pointwise([FlipX(), RescaleImages(1. / 255., 0.), Cast(np.float16)])
+        assert len(chain) == 2
+        r = chain[1].apply({"images": arr.copy()}, deterministic=True)
+        assert r["images"].dtype == np.float16
+        assert np.allclose(r["images"], arr / 255., atol=1e-3)
+
+        r = Cast(np.uint8).apply({"images": np.array([[-3.2, 7.6, 300.]])})
+        assert (r["images"] == [[0, 8, 255]]).all()
+
+    def test_resize_batch(self):
+        yy, xx = np.mgrid[0:60, 0:80]
+        image = np.stack([xx * 3, yy * 4, xx + yy], -1).astype(np.uint8)
+        arr = np.stack([image, image[::-1]])
+
+        r = Resize((30, 50), interp="bilinear").apply({"images": arr})
+        assert r["images"].shape == (2, 30, 50, 3) and r["images"].dtype == np.uint8
+        expected = np.array(Image.fromarray(image).resize((50, 30), Image.BILINEAR))
+        assert np.abs(r["images"][0].astype(int) - expected).max() <= 1
+
+        threaded = Resize((30, 50), interp="bilinear", n_threads=2).apply({"images": arr})
+        assert (threaded["images"] == r["images"]).all()
+
+        r = Resize(40, mode="width").apply({"images": [image, image[:30]]})
+        assert [i.shape for i in r["images"]] == [(30, 40, 3), (15, 40, 3)]
+
+    def test_resize_weights_cache_is_bounded(self):
+        for size in range(200):
+            resize_weights(size + 1, 7)
+        info = resize_weights.cache_info()
+        assert info.currsize <= info.maxsize < 200
+        assert resize_weights(10, 7) is resize_weights(10, 7)
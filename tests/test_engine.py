@@ -1,7 +1,58 @@
 import time
+import numpy as np
+import pytest
 
-from highway.engine import Pipeline
-from highway.modules.processing import Noise, Augmentations
+from highway.engine import Node, Graph, Pipeline, Autoscaler, Stop
+from highway.transports import SharedMemoryQueue
+from highway.modules.processing import Noise, Augmentations, Coalesce, Merge
+from highway.augmentations.base import Augmentation
+from highway.augmentations.img import FlipX, RescaleImages
+from highway.modules.fs import ClfImgReader, ImgReader
+
+
+class Sleep(Augmentation):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def apply(self, values, deterministic=False):
+        time.sleep(self.seconds)
+        return values
+
+
+class Jitter(Augmentation):
+    """
+    Sleeps longer for even items so that workers finish out of order.
+    """
+    def apply(self, values, deterministic=False):
+        time.sleep(0.02 if values["images"][0] % 2 == 0 else 0.)
+        return values
+
+
+class Idle(Node):
+    def loop(self):
+        time.sleep(0.3)
+
+
+class Negate(Augmentation):
+    def apply(self, values, deterministic=False):
+        values["images"] *= -1
+        return values
+
+
+class Counter(Node):
+    def __init__(self, size=1, limit=None, **kwargs):
+        self.size = size
+        self.limit = limit
+        super(Counter, self).__init__(**kwargs)
+
+    def setup(self):
+        self.count = 0
+
+    def loop(self):
+        if self.count == self.limit:
+            raise Stop()
+        self.enqueue({"images": np.full(self.size, self.count)})
+        self.count += 1
 
 
 class TestEngine:
@@ -20,3 +71,267 @@ class TestEngine:
         assert len(data["images"]) == 2
         assert data["images"].shape == (2, 3, 5)
         p.stop()
+
+    def test_stats(self):
+        p = Pipeline([Noise(data_shape=(3, 5), n_tensors=2), Augmentations(n_worker=2)])
+        for _ in range(5):
+            p.dequeue()
+        stats = p.stats()
+        assert [s["node"] for s in stats] == ["Noise", "Augmentations"]
+        assert stats[0]["items_out"] >= 5
+        assert stats[1]["items_in"] >= 5
+        assert stats[1]["items_out"] >= 5
+        assert stats[1]["loops"] >= 5
+        assert 0. <= stats[0]["occupancy_mean"] <= 1.
+        p.stop()
+
+    def test_autoscaler_decisions(self):
+        scaler = Autoscaler([])
+        # Input piles up, output drained: bottleneck
+        assert scaler.decide(0.9, 0.1) == 1
+        # Consumers cannot keep up
+        assert scaler.decide(0.9, 0.9) == -1
+        # Starved for input
+        assert scaler.decide(0.0, 0.0) == -1
+        assert scaler.decide(0.5, 0.5) == 0
+        # Sources only look at their output
+        assert scaler.decide(None, 0.0) == 1
+
+    def test_autoscaling(self):
+        slow = Augmentations([Sleep(0.05)], n_worker=1, queue_size=4, autoscale=(1, 3))
+        p = Pipeline([Noise(data_shape=(3, 5), n_tensors=2, queue_size=4), slow], autoscale_interval=0.1)
+        s = time.time()
+        while slow.n_worker < 2 and time.time() - s < 10:
+            p.dequeue()
+        assert slow.n_worker >= 2
+        p.stop()
+
+    def test_worker_ids_stay_below_max_worker(self):
+        node = Idle(n_worker=3, autoscale=(1, 3), executor="thread")
+        node.start_daemons()
+        node.retire_worker()
+        # The retiring worker still holds the last id
+        assert not node.add_worker()
+        s = time.time()
+        while len([p for p in node.processes if p.is_alive()]) > 2 and time.time() - s < 5:
+            time.sleep(0.05)
+        assert node.add_worker()
+        assert sorted(node.worker_ids.values()) == [0, 1, 2]
+        node.stop_processes()
+
+    def test_thread_executor(self):
+        p = Pipeline([Noise(data_shape=(3, 5), n_tensors=2, executor="thread"),
+                      Augmentations(n_worker=2, executor="thread")])
+        for _ in range(5):
+            data = p.dequeue()
+            assert data["images"].shape == (2, 3, 5)
+        assert p.stats()[1]["items_in"] >= 5
+        p.stop()
+
+    def test_inline_executor(self):
+        p = Pipeline([Noise(data_shape=(3, 5), n_tensors=2), Augmentations(executor="inline")])
+        for _ in range(5):
+            data = p.dequeue()
+            assert data["images"].shape == (2, 3, 5)
+        assert p.stats()[1]["loops"] == 5
+        p.stop()
+
+    def test_thread_nodes_cannot_feed_processes(self):
+        with pytest.raises(ValueError):
+            Pipeline([Noise(executor="thread"), Augmentations(executor="inline"), Augmentations()])
+
+    def test_bulk_enqueue_dequeue(self):
+        node = Node(executor="thread")
+        node.enqueue_many([1, 2, 3])
+        node.enqueue(4)
+        assert node.dequeue_many(2) == [1, 2]
+        assert node.dequeue_many(10) == [3, 4]
+
+    def test_coalesce(self):
+        p = Pipeline([Noise(data_shape=(3, 5), n_tensors=2), Coalesce(5)])
+        for _ in range(3):
+            data = p.dequeue()
+            assert data["images"].shape == (5, 3, 5)
+        p.stop()
+        # Items from shared memory slots must outlive the dequeues that collect the rest of the batch
+        p = Pipeline([Counter(queue_size=SharedMemoryQueue(maxsize=2, slot_size=1024)), Coalesce(8)])
+        for _ in range(10):
+            images = p.dequeue()["images"]
+            assert (images == np.arange(images[0], images[0] + 8)).all()
+        p.stop()
+
+    def test_ordered_augmentations(self):
+        p = Pipeline([Counter(), Augmentations([Jitter()], n_worker=4, deterministic=True, ordered=True)])
+        received = [p.dequeue()["images"][0] for _ in range(20)]
+        assert received == list(range(20))
+        p.stop()
+
+    def test_deterministic_augmentations_unordered_by_default(self):
+        p = Pipeline([Counter(), Augmentations(deterministic=True), Augmentations()])
+        assert not p.nodes[1].ordered
+        assert p.dequeue()["images"].shape == (1,)
+        p.stop()
+
+    def test_graph_broadcast(self):
+        graph = Graph()
+        counter = graph.add(Counter())
+        left = graph.add(Augmentations(n_worker=1), inputs=[counter])
+        right = graph.add(Augmentations(n_worker=1), inputs=[counter])
+        graph.start()
+        for idx in range(5):
+            assert graph.dequeue(node=left)["images"][0] == idx
+            assert graph.dequeue(node=right)["images"][0] == idx
+        graph.stop()
+
+    def test_graph_broadcast_copies_for_in_place_consumers(self):
+        graph = Graph()
+        counter = graph.add(Counter(executor="thread", queue_size=4, size=1 << 20))
+        left = graph.add(Augmentations([Negate()], n_worker=1, executor="thread"), inputs=[counter])
+        right = graph.add(Augmentations(n_worker=1, executor="thread"), inputs=[counter])
+        graph.start()
+        for idx in range(50):
+            assert (graph.dequeue(node=left)["images"] == -idx).all()
+            assert (graph.dequeue(node=right)["images"] == idx).all()
+        graph.stop()
+
+    def test_graph_round_robin_and_merge(self):
+        graph = Graph()
+        counter = graph.add(Counter(fanout="round_robin", queue_size=2))
+        left = graph.add(Augmentations(n_worker=1), inputs=[counter])
+        right = graph.add(Augmentations(n_worker=1), inputs=[counter])
+        merge = graph.add(Merge(), inputs=[left, right])
+        graph.start()
+        received = [graph.dequeue()["images"][0] for _ in range(20)]
+        assert len(set(received)) == 20
+        assert graph.sinks() == [merge]
+        graph.stop()
+
+    def test_merge_concat(self):
+        graph = Graph()
+        a = graph.add(Noise(data_shape=(3, 5), n_tensors=2))
+        b = graph.add(Noise(data_shape=(3, 5), n_tensors=3))
+        graph.add(Merge(mode="concat"), inputs=[a, b])
+        graph.start()
+        assert graph.dequeue()["images"].shape == (5, 3, 5)
+        graph.stop()
+
+    def test_iterate_with_prefetch(self):
+        pipeline = Pipeline([Counter()])
+        batches = pipeline.iterate(prefetch=3)
+        received = [next(batches)["images"][0] for _ in range(10)]
+        assert received == list(range(10))
+        pipeline.stop()
+        # Drains what is left in the queues, then ends
+        list(batches)
+        assert not batches.is_alive()
+
+    def test_next_batch(self):
+        import asyncio
+        pipeline = Pipeline([Counter()])
+        loop = asyncio.new_event_loop()
+        first = loop.run_until_complete(pipeline.next_batch(loop=loop))
+        second = loop.run_until_complete(pipeline.next_batch(loop=loop))
+        assert first["images"][0] == 0 and second["images"][0] == 1
+        loop.close()
+
+        async def fetch():
+            return await pipeline.next_batch()
+
+        assert asyncio.run(fetch())["images"][0] == 2
+        pipeline.stop()
+
+    def test_async_iteration_ends_on_stop(self):
+        import asyncio
+        pipeline = Pipeline([Counter()])
+
+        async def consume():
+            received = 0
+            async for _ in pipeline:
+                received += 1
+                if received == 5:
+                    pipeline.stop()
+            return received
+
+        assert asyncio.run(consume()) >= 5
+
+    def test_augmentations_dtype(self):
+        p = Pipeline([Noise(data_shape=(3, 5), n_tensors=2),
+                      Augmentations([RescaleImages(1., 0.)], dtype=np.float16, n_worker=1)])
+        assert p.dequeue()["images"].dtype == np.float16
+        p.stop()
+
+    def test_seeded_workers(self):
+        flips = []
+        for _ in range(2):
+            p = Pipeline([Noise(data_shape=(3, 5), n_tensors=16),
+                          Augmentations([FlipX()], n_worker=1, record_params=True, seed=7)])
+            flips.append(p.dequeue()["params"][0]["flip"])
+            p.stop()
+        assert (flips[0] == flips[1]).all()
+
+    def test_transform_timings(self):
+        aug = Augmentations([Sleep(0.01), FlipX(), RescaleImages()], n_worker=2, profile=True)
+        p = Pipeline([Noise(data_shape=(3, 5), n_tensors=2), aug])
+        for _ in range(5):
+            p.dequeue()
+        p.stop()
+        stats = aug.transform_stats()
+        assert [s["transform"] for s in stats] == ["Sleep", "FlipX", "Fused(RescaleImages)"]
+        assert stats[0]["calls"] >= 5 and stats[0]["bytes"] >= 5 * 2 * 3 * 5 * 8
+        assert stats[0]["time"] > stats[1]["time"]
+        assert aug.report().split("\n")[1].startswith("Sleep")
+
+    def test_sharded_reader_covers_an_epoch(self, tmp_path):
+        from PIL import Image
+        for idx in range(10):
+            Image.fromarray(np.full((4, 6, 3), idx, np.uint8)).save(str(tmp_path / ("%d.png" % idx)))
+        reader = ImgReader(str(tmp_path), batch_size=2, once=True, executor="thread", shape=(4, 6),
+                           sharded=True, shard_size=3, shuffle_buffer=2, n_worker=2, cache_bytes=1 << 20)
+        p = Pipeline([reader])
+        keys = []
+        # Ends once both workers have read their shards
+        for batch in p.iterate():
+            assert (batch["images"][:, 0, 0, 0] == [int(reader.filenames[k][0]) for k in batch["keys"]]).all()
+            keys.extend(batch["keys"])
+        p.stop()
+        assert sorted(keys) == list(range(10))
+        assert reader.cache.stats()["misses"] == 10
+
+    def test_exhausted_source_stops_its_consumers(self):
+        p = Pipeline([Counter(limit=6, n_worker=2), Augmentations(n_worker=2)])
+        received = sorted(batch["images"][0] for batch in p.iterate())
+        assert received == [0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5]
+        p.stop()
+
+    def test_stop_passes_through_merge(self):
+        graph = Graph()
+        a = graph.add(Counter(limit=3))
+        b = graph.add(Counter(limit=4))
+        graph.add(Merge(), inputs=[a, b])
+        graph.start()
+        received = sorted(batch["images"][0] for batch in graph.iterate())
+        graph.stop()
+        assert received == [0, 0, 1, 1, 2, 2, 3]
+
+    def test_reader_once_stops_after_partial_batch(self, tmp_path):
+        from PIL import Image
+        for idx in range(5):
+            Image.fromarray(np.full((4, 6, 3), idx, np.uint8)).save(str(tmp_path / ("%d.png" % idx)))
+        p = Pipeline([ImgReader(str(tmp_path), batch_size=2, random=False, once=True, shape=(4, 6))])
+        keys = [key for batch in p.iterate() for key in batch["keys"]]
+        p.stop()
+        assert keys == list(range(5))
+
+    def test_reader_workers_share_their_cache(self, tmp_path):
+        from PIL import Image
+        for cls in range(2):
+            (tmp_path / str(cls)).mkdir()
+            for idx in range(4):
+                Image.fromarray(np.full((4, 6, 3), cls, np.uint8)).save(str(tmp_path / str(cls) / ("%d.png" % idx)))
+        reader = ClfImgReader(str(tmp_path), 4, (4, 6), n_worker=2)
+        p = Pipeline([reader])
+        for _ in range(4):
+            batch = p.dequeue()
+            assert (batch["images"][:, 0, 0, 0] == batch["labels"].argmax(1)).all()
+        p.stop()
+        assert any(reader.cache.get(sample) is not None for sample in range(8))
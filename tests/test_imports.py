@@ -0,0 +1,27 @@
+import subprocess
+import sys
+
+# Generous upper bound for importing all highway modules in a fresh interpreter, numpy included
+IMPORT_BUDGET = 1.5
+
+HEAVY_MODULES = ['scipy', 'PIL', 'plyvel', 'zmq', 'msgpack', 'msgpack_numpy']
+
+SCRIPT = """
+import sys
+from timeit import default_timer as timer
+start = timer()
+import highway.engine, highway.transports, highway.utils, highway.adapters, highway.debug
+import highway.modules.fs, highway.modules.db, highway.modules.network, highway.modules.processing
+import highway.modules.shards
+import highway.augmentations.img, highway.transforms.img
+print(timer() - start)
+print(','.join(m for m in %r if m in sys.modules))
+""" % HEAVY_MODULES
+
+
+class TestImports:
+    def test_heavy_dependencies_are_lazy(self):
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT]).decode().split('\n')
+        elapsed, loaded = float(output[0]), output[1]
+        assert loaded == ''
+        assert elapsed < IMPORT_BUDGET
@@ -0,0 +1,49 @@
+import json
+import numpy as np
+from PIL import Image
+
+from highway.modules.shards import pack_shards, ShardReader, META_FILE
+from highway.engine import Pipeline
+
+
+def write_dataset(data_dir, n_classes=2, n_images=5):
+    for cls in range(n_classes):
+        (data_dir / ("class%d" % cls)).mkdir(parents=True)
+        for idx in range(n_images):
+            image = np.full((8, 10, 3), cls * 10 + idx, np.uint8)
+            Image.fromarray(image).save(str(data_dir / ("class%d" % cls) / ("%d.png" % idx)))
+
+
+class TestShards:
+    def test_pack_labeled_directory(self, tmp_path):
+        write_dataset(tmp_path / "data")
+        assert pack_shards(str(tmp_path / "data"), str(tmp_path / "shards"), shard_bytes=500) == 10
+        meta = json.load(open(str(tmp_path / "shards" / META_FILE)))
+        assert meta['classes'] == ["class0", "class1"]
+        assert len(meta['shards']) > 1 and sum(meta['counts']) == 10
+
+    def test_sequential_reading_covers_an_epoch(self, tmp_path):
+        write_dataset(tmp_path / "data")
+        pack_shards(str(tmp_path / "data"), str(tmp_path / "shards"), shard_bytes=500, seed=0)
+        reader = ShardReader(str(tmp_path / "shards"), batch_size=3, shape=(8, 10), random=False, once=True,
+                             shuffle_buffer=4, n_worker=2, executor="thread")
+        p = Pipeline([reader])
+        keys = []
+        for batch in p.iterate():
+            # Pixel values encode class and file
+            for image, key, label in zip(batch["images"], batch["keys"], batch["labels"]):
+                cls, idx = key.split("/")
+                assert image[0, 0, 0] == int(cls[-1]) * 10 + int(idx[0])
+                assert label.argmax() == int(cls[-1])
+            keys.extend(batch["keys"])
+        p.stop()
+        assert sorted(keys) == sorted("class%d/%d.png" % (c, i) for c in range(2) for i in range(5))
+
+    def test_random_reading_of_unlabeled_images(self, tmp_path):
+        write_dataset(tmp_path / "data", n_classes=1)
+        pack_shards(str(tmp_path / "data" / "class0"), str(tmp_path / "shards"))
+        p = Pipeline([ShardReader(str(tmp_path / "shards"), batch_size=4)])
+        batch = p.dequeue()
+        p.stop()
+        assert "labels" not in batch
+        assert len(batch["images"]) == 4 and batch["images"][0].shape == (8, 10, 3)
@@ -0,0 +1,69 @@
+import numpy as np
+
+from highway.engine import Node, Pipeline
+from highway.modules.processing import Noise, Augmentations
+from highway.transports import SharedMemoryQueue, detach
+
+
+class Filler(Node):
+    """
+    Emits large batches filled with a running count.
+    """
+    def setup(self):
+        self.count = 0
+
+    def loop(self):
+        self.enqueue({"images": np.full((4, 256, 256), self.count, dtype=np.int64)})
+        self.count += 1
+
+
+class TestSharedMemoryQueue:
+    def test_roundtrip(self):
+        q = SharedMemoryQueue(maxsize=2, slot_size=1024)
+        images = np.arange(24, dtype=np.uint8).reshape(2, 3, 4)
+        q.put({"images": images, "keys": ["a", "b"], "labels": (np.ones(2), 3)})
+        data = q.get()
+        assert np.array_equal(data["images"], images)
+        assert data["keys"] == ["a", "b"]
+        assert np.array_equal(data["labels"][0], np.ones(2))
+        assert data["labels"][1] == 3
+
+    def test_oversized_items_fall_back_to_pickling(self):
+        q = SharedMemoryQueue(maxsize=1, slot_size=64)
+        images = np.zeros((10, 10), dtype=np.float64)
+        q.put({"images": images})
+        data = q.get()
+        assert data["images"].shape == (10, 10)
+
+    def test_slots_are_recycled(self):
+        q = SharedMemoryQueue(maxsize=1, slot_size=1024)
+        for idx in range(5):
+            q.put({"images": np.full((4,), idx)})
+            assert q.get()["images"][0] == idx
+            q.release()
+
+    def test_detach(self):
+        q = SharedMemoryQueue(maxsize=1, slot_size=1024)
+        q.put({"images": np.zeros(4)})
+        data = q.get()
+        own = np.ones(4)
+        detached = detach({"images": data["images"], "labels": own}, [q])
+        assert not q.owns(detached["images"])
+        assert detached["labels"] is own
+
+    def test_pipeline(self):
+        noise = Noise(data_shape=(3, 5), n_tensors=2, queue_size=SharedMemoryQueue(maxsize=4, slot_size=1024))
+        p = Pipeline([noise, Augmentations(queue_size=SharedMemoryQueue(maxsize=4, slot_size=1024))])
+        for _ in range(5):
+            data = p.dequeue()
+            assert data["images"].shape == (2, 3, 5)
+        p.stop()
+
+    def test_views_forwarded_to_pickling_queues_stay_valid(self):
+        # The consumer passes views into input slots on to a multiprocessing queue, which pickles them later
+        source = Filler(queue_size=SharedMemoryQueue(maxsize=2, slot_size=4 * 256 * 256 * 8))
+        p = Pipeline([source, Augmentations(n_worker=1)])
+        for idx in range(60):
+            images = p.dequeue()["images"]
+            assert (images == idx).all()
+        p.stop()
@@ -0,0 +1,195 @@
+import multiprocessing
+import threading
+import numpy as np
+import pytest
+
+from highway.utils import BufferPool, ByteBudgetCache, EncodedImageCache, FIFOCache, SharedArrayCache, \
+    load_and_fit_image, load_image, open_reduced, shard_indices, shuffled_stream
+
+
+class TestBufferPool:
+    def test_buffers_are_recycled_once_dropped(self):
+        pool = BufferPool()
+        a = pool.acquire((4, 3), np.float32)
+        b = pool.acquire((4, 3), np.float32)
+        assert a is not b
+        address = b.ctypes.data
+        del b
+        assert pool.acquire((4, 3), np.float32).ctypes.data == address
+
+    def test_views_keep_buffers_alive(self):
+        pool = BufferPool()
+        a = pool.acquire((4, 3), np.uint8)
+        view = a[1:]
+        address = a.ctypes.data
+        del a
+        assert pool.acquire((4, 3), np.uint8).ctypes.data != address
+        del view
+
+    def test_shape_and_dtype(self):
+        pool = BufferPool(max_buffers=1)
+        assert pool.acquire((2, 2), np.uint8).dtype == np.uint8
+        assert pool.acquire((3,), np.float64).shape == (3,)
+
+
+def write_image(path, height, width):
+    from PIL import Image
+    yy, xx = np.mgrid[0:height, 0:width]
+    image = np.stack([xx % 256, yy % 256, (xx + yy) % 256], -1).astype(np.uint8)
+    Image.fromarray(image).save(str(path))
+    return str(path)
+
+
+class TestImageLoading:
+    def test_jpeg_is_decoded_at_reduced_size(self, tmp_path):
+        filename = write_image(tmp_path / "big.jpg", 1200, 1600)
+        img = open_reduced(filename, (240, 320))
+        assert 320 <= img.size[0] < 800 and 240 <= img.size[1] < 600
+        assert load_and_fit_image(filename, (240, 320)).shape == (240, 320, 3)
+
+    def test_other_formats_are_reduced(self, tmp_path):
+        filename = write_image(tmp_path / "big.png", 1000, 1000)
+        img = open_reduced(filename, (100, 200))
+        assert img.size == (200, 200)
+        assert load_image(filename, (100, 200)).shape == (100, 200, 3)
+        assert load_image(filename).shape == (1000, 1000, 3)
+
+    def test_palette_images_are_not_reduced(self, tmp_path):
+        from PIL import Image
+        filename = str(tmp_path / "palette.png")
+        Image.open(write_image(tmp_path / "big.png", 1000, 1000)).convert('P').save(filename)
+        assert open_reduced(filename, (100, 200)).size == (1000, 1000)
+        assert load_image(filename, (100, 200)).shape == (100, 200)
+
+
+class TestShardedStream:
+    def test_shards_of_all_workers_cover_every_item_once(self):
+        shards = [shard for worker in range(3) for shard in shard_indices(20, 4, worker, 3)]
+        assert sorted(np.concatenate(shards).tolist()) == list(range(20))
+        assert all(np.all(np.diff(shard) == 1) for shard in shards)
+
+    def test_every_epoch_is_complete_and_shuffled(self):
+        rng = np.random.default_rng(0)
+        stream = shuffled_stream(shard_indices(50, 5), lambda idx: idx * 2, 8, rng)
+        epochs = [[next(stream) for _ in range(50)] for _ in range(2)]
+        for epoch in epochs:
+            assert sorted(idx for idx, _ in epoch) == list(range(50))
+            assert all(value == idx * 2 for idx, value in epoch)
+        assert [idx for idx, _ in epochs[0]] != list(range(50))
+
+    def test_once_stops_after_an_epoch(self):
+        stream = shuffled_stream(shard_indices(7, 3), lambda idx: idx, 2, np.random.default_rng(0), once=True)
+        assert sorted(idx for idx, _ in stream) == list(range(7))
+
+
+def fill_cache(cache):
+    cache.set(1, np.arange(12, dtype=np.float32).reshape(3, 4))
+
+
+class TestSharedArrayCache:
+    def test_arrays_set_in_other_processes_are_visible(self):
+        cache = SharedArrayCache(4, 2, 64)
+        proc = multiprocessing.Process(target=fill_cache, args=(cache,))
+        proc.start()
+        proc.join()
+        assert cache.get(0) is None
+        cached = cache.get(1)
+        assert cached.dtype == np.float32
+        assert (cached == np.arange(12).reshape(3, 4)).all()
+
+    def test_slots_are_reused_and_large_arrays_skipped(self):
+        cache = SharedArrayCache(4, 2, 8)
+        for key in range(3):
+            cache.set(key, np.full(2, key, np.int32))
+        cache.set(3, np.zeros(3, np.int32))
+        assert cache.get(0) is None and cache.get(3) is None
+        assert (cache.get(2) == 2).all() and cache.get(2).shape == (2,)
+
+
+class TestByteBudgetCache:
+    def test_lru_keeps_recently_used_values(self):
+        cache = ByteBudgetCache(max_bytes=30, policy='lru')
+        for key in range(3):
+            cache.set(key, np.zeros(10, np.uint8))
+        cache.get(0)
+        cache.set(3, np.zeros(10, np.uint8))
+        assert 0 in cache and 1 not in cache
+        assert cache.bytes == 30
+
+    def test_clock_spares_referenced_values(self):
+        cache = ByteBudgetCache(max_bytes=30, policy='clock')
+        for key in range(3):
+            cache.set(key, b"x" * 10)
+        cache.get(1)
+        cache.set(3, b"x" * 10)
+        cache.set(4, b"x" * 10)
+        assert 1 in cache and 3 in cache and 4 in cache
+
+    @pytest.mark.parametrize('policy', ByteBudgetCache.POLICIES)
+    def test_budget_is_respected(self, policy):
+        cache = ByteBudgetCache(max_bytes=1000, policy=policy, seed=0)
+        rng = np.random.default_rng(0)
+        for key in range(200):
+            cache.set(key, np.zeros(rng.integers(1, 300), np.uint8))
+            cache.get(rng.integers(key + 1))
+            assert cache.bytes <= 1000
+        stats = cache.stats()
+        assert stats['evictions'] > 0 and stats['hits'] + stats['misses'] == 200
+
+    def test_admission_and_counters(self):
+        cache = ByteBudgetCache(max_bytes=100, admit=lambda key, value: key % 2 == 0)
+        cache.set(0, np.zeros(10))
+        cache.set(1, np.zeros(1))
+        cache.set(2, np.zeros(1, np.uint8))
+        cache.set(4, np.zeros(101, np.uint8))
+        assert cache.get(1) is None and cache.get(2) is not None
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['rejections'], stats['items']) == (1, 1, 2, 2)
+        assert stats['bytes'] == 81
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            ByteBudgetCache(policy='fifo')
+
+
+class TestEncodedImageCache:
+    def test_file_is_read_once_and_decoded_on_hits(self, tmp_path):
+        filename = write_image(tmp_path / "img.png", 40, 60)
+        cache = EncodedImageCache(max_bytes=1 << 20, shape=(20, 30))
+        first = cache.load(0, filename)
+        (tmp_path / "img.png").unlink()
+        assert first.shape == (20, 30, 3)
+        assert (cache.load(0, filename) == first).all()
+        stats = cache.stats()['encoded']
+        assert (stats['hits'], stats['misses']) == (1, 1)
+        assert stats['bytes'] < first.nbytes
+
+    def test_decoded_tier_is_consulted_first(self, tmp_path):
+        filename = write_image(tmp_path / "img.png", 40, 60)
+        cache = EncodedImageCache(max_bytes=1 << 20, decoded_bytes=1 << 20)
+        cache.load(0, filename)
+        cache.load(0, filename)
+        stats = cache.stats()
+        assert stats['decoded']['hits'] == 1 and stats['encoded']['hits'] == 0
+
+
+class TestFIFOCache:
+    def test_concurrent_access(self):
+        cache = FIFOCache(size_limit=8)
+        errors = []
+
+        def hammer(offset):
+            try:
+                for idx in range(20000):
+                    cache.set(idx + offset, idx)
+                    cache.get(idx + offset - 4)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=hammer, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(cache.store) <= 8